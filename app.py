@@ -1,12 +1,30 @@
 import streamlit as st
+import asyncio
 import random
 import json
+import re
+import string
 from dotenv import load_dotenv
 import os
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, ClassVar
+import atexit
+import bisect
 import datetime
+import hashlib
+import mmap
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 # Configuration class
 @dataclass
@@ -15,6 +33,59 @@ class Config:
     MAX_CONTEXT_LENGTH: int = 1048576
     MAX_OUTPUT_TOKENS: int = 8192
     ROUNDS_PER_GAME: int = 5
+    SCENARIO_POOL_ENABLED: bool = True
+    SCENARIO_POOL_DEPTH: int = 2
+    SCENARIO_POOL_RETRY_DELAY: float = 5.0
+    PREFETCH_ENABLED: bool = True
+    GENERATION_WORKERS: int = 8  # Threads for background retry loops; Gemini concurrency is MAX_IN_FLIGHT_REQUESTS
+    FOREGROUND_WORKERS: int = 8  # Threads for rounds a player is waiting on, kept apart from background generation
+    MAX_IN_FLIGHT_REQUESTS: int = 4  # Concurrent Gemini calls across every generation path in the process
+    RATE_LIMIT_REQUESTS_PER_MINUTE: int = 60  # Process-wide Gemini request budget; 0 disables
+    RATE_LIMIT_TOKENS_PER_MINUTE: int = 1000000  # Process-wide Gemini token budget; 0 disables
+    COALESCE_REQUESTS: bool = True  # Concurrent identical live requests share one Gemini call
+    COALESCE_WINDOW_SECONDS: float = 0.1  # How long a live call waits for joiners while other live calls are open
+    COALESCE_MAX_WAITERS: int = 4  # Extra requests one call may absorb
+    SCENARIO_BANK_ENABLED: bool = True  # Serve precompiled scenarios from build_scenario_bank.py
+    SCENARIO_BANK_PATH: str = "scenario_bank.bin"
+    LEADERBOARD_PATH: str = "leaderboard.db"
+    LEADERBOARD_TOP_K: int = 10
+    LEADERBOARD_REFRESH_SECONDS: float = 10.0  # Re-read the top-K snapshot so scores from other processes show up
+    HISTORY_ENABLED: bool = True  # Keep every answered round in an append-only SQLite store
+    HISTORY_PATH: str = "round_history.db"
+    HISTORY_BATCH_SIZE: int = 200  # Rounds written per transaction
+    HISTORY_FLUSH_SECONDS: float = 1.0  # Longest a round waits in the buffer before it is written
+    HISTORY_WRITE_ATTEMPTS: int = 5  # Tries per batch, with exponential backoff, before it is spilled to a file
+    HISTORY_RETRY_BASE: float = 0.5  # Seconds before the first retry of a failed batch
+    GEMINI_TOP_UP: bool = True  # Call Gemini when the bank and caches have nothing suitable; False serves fallbacks instead
+    SCENARIO_BATCH_SIZE: int = 5  # Scenarios requested per Gemini call; 1 disables batching
+    PREGENERATE_GAME: bool = False  # Generate every round in parallel when the game starts
+    SCENARIO_STORE_ENABLED: bool = True
+    SCENARIO_STORE_PATH: str = "scenario_cache.db"
+    SCENARIO_STORE_MAX_ROWS: int = 5000
+    SCENARIO_REUSE_POLICY: str = "per_player"  # "per_player", "once" or "always"
+    SCENARIO_CACHE_ENABLED: bool = True
+    SCENARIO_CACHE_MAX_ENTRIES: int = 2000
+    SCENARIO_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    SCENARIO_CACHE_TTL_SECONDS: float = 3600.0
+    STREAM_SCENARIOS: bool = True  # Render live-generated scenarios as the model streams them
+    GENERATION_MAX_ATTEMPTS: int = 5
+    GENERATION_RETRY_DEADLINE: float = 20.0  # Seconds before a request gives up and falls back
+    GENERATION_BACKOFF_BASE: float = 0.5
+    GENERATION_QUOTA_BACKOFF_BASE: float = 2.0
+    GENERATION_BACKOFF_MAX: float = 8.0
+    CIRCUIT_FAILURE_THRESHOLD: int = 5  # Consecutive model failures before the circuit opens
+    CIRCUIT_RESET_SECONDS: float = 30.0  # Time open before a half-open probe is allowed
+    MODEL_CALL_TIMEOUT: float = 30.0  # Seconds per Gemini request
+    TOKEN_COUNT_TIMEOUT: float = 5.0  # Seconds per count_tokens request before falling back to the estimate
+    TOKEN_COUNT_RETRY_SECONDS: float = 300.0  # Keep serving the estimate this long after a failed count
+    ROUND_LATENCY_BUDGET: float = 4.0  # Seconds a round may wait on the model before serving a fallback; 0 disables
+    STRUCTURED_OUTPUT: bool = True  # Ask Gemini for schema-constrained JSON instead of free text
+    CONTEXT_CACHE_ENABLED: bool = False  # Keep the static prompt prefix in a Gemini cached-content object
+    CONTEXT_CACHE_MODEL: str = "models/gemini-1.5-pro-002"  # Cached calls run on this explicit version, not MODEL_NAME
+    CONTEXT_CACHE_MIN_TOKENS: int = 32768  # Gemini 1.5 refuses to cache smaller contents
+    CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    CONTEXT_CACHE_RENEW_SECONDS: int = 300  # Extend the TTL once less than this remains
+    CONTEXT_CACHE_RETRY_SECONDS: float = 600.0  # Wait before retrying after the cache could not be created
 
 # Load environment variables
 load_dotenv(override=True)
@@ -23,15 +94,13 @@ load_dotenv(override=True)
 genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 
 # Initialize Gemini model
-model = genai.GenerativeModel(
-    Config.MODEL_NAME,
-    generation_config={
-        'temperature': 0.7,
-        'top_p': 0.8,
-        'top_k': 40,
-        'max_output_tokens': Config.MAX_OUTPUT_TOKENS
-    }
-)
+GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'top_p': 0.8,
+    'top_k': 40,
+    'max_output_tokens': Config.MAX_OUTPUT_TOKENS
+}
+model = genai.GenerativeModel(Config.MODEL_NAME, generation_config=GENERATION_CONFIG)
 
 # Page configuration
 st.set_page_config(
@@ -93,6 +162,7 @@ FALLBACK_SCENARIOS = [
     {
         "scenario": "During boarding, a passenger is struggling with an oversized bag while others wait",
         "context": "Boarding",
+        "category": "customer_service",
         "difficulty": "Easy",
         "points": 5,
         "options": [
@@ -100,80 +170,389 @@ FALLBACK_SCENARIOS = [
             {"text": "Let them keep trying while the line builds up", "is_correct": False},
             {"text": "Tell them they have to check it at the counter", "is_correct": False}
         ],
-        "explanation": "Offering free gate-check keeps boarding moving and maintains good customer service."
+        "explanation": "Offering free gate-check keeps boarding moving and maintains good customer service.",
+        "fun_facts": [
+            "Southwest Airlines lets every passenger check two bags free of charge",
+            "Southwest's open seating boarding process uses boarding groups A, B and C",
+            "Southwest's first flight took off from Dallas Love Field in 1971"
+        ]
     },
     # Add more fallback scenarios here...
 ]
-    
 
-class GameManager:
-    def __init__(self):
-        self.initialize_session_state()
-        
-    def initialize_session_state(self):
-        """Initialize all session state variables"""
-        if 'game_active' not in st.session_state:
-            st.session_state.game_active = False
-        if 'current_round' not in st.session_state:
-            st.session_state.current_round = 0
-        if 'total_score' not in st.session_state:
-            st.session_state.total_score = 0
-        if 'player_name' not in st.session_state:
-            st.session_state.player_name = ""
-        if 'game_history' not in st.session_state:
-            st.session_state.game_history = []
-        if 'leaderboard' not in st.session_state:
-            st.session_state.leaderboard = []
-        if 'current_scenario' not in st.session_state:
-            st.session_state.current_scenario = None
-        if 'showing_answer' not in st.session_state:
-            st.session_state.showing_answer = False
-        if 'player_role' not in st.session_state:
-            st.session_state.player_role = "Any"  # Default to "Any" if no role selected
-        if 'show_about' not in st.session_state:
-            st.session_state.show_about = False
-        if 'topic_categories' not in st.session_state:
-            st.session_state.topic_categories = {
-                'customer_service': [],
-                'operations': [],
-                'culture': [],
-                'history': [],
-                'technical': [],
-                'fun_moments': [],
-                'problem_solving': [],
-                'teamwork': [],
-                'leadership': [],
-                'innovation': []
+# Roles a player can pick; "Any Role" asks for scenarios that are not role-specific
+PLAYER_ROLES = [
+    "Any Role",
+    "Flight Attendant",
+    "Pilot",
+    "Ground Operations",
+    "Customer Service Agent",
+    "Operations Agent"
+]
+
+# Categories tracked per session to keep scenario topics balanced
+SCENARIO_CATEGORIES = [
+    'customer_service',
+    'operations',
+    'culture',
+    'history',
+    'technical',
+    'fun_moments',
+    'problem_solving',
+    'teamwork',
+    'leadership',
+    'innovation'
+]
+
+
+def scenario_content_hash(scenario):
+    """Stable hash of a scenario's question and option texts, used to spot duplicates"""
+    options = sorted(str(option.get('text', '')).strip().lower() for option in scenario.get('options', []))
+    content = "\n".join([str(scenario.get('scenario', '')).strip().lower()] + options)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Process-wide breaker that stops calling Gemini after repeated failures and probes for recovery"""
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.total_open_seconds = 0.0
+        self.rejected_calls = 0
+        self._probe_in_flight = False
+        self.transitions = deque(maxlen=20)
+
+    def _check_reset(self):
+        # Called with the lock held: an open circuit becomes half-open once the reset period has passed
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self._transition("half_open")
+
+    def is_open(self):
+        """Return True while calls would be rejected; applies the reset timeout so callers can send the probe"""
+        with self._lock:
+            self._check_reset()
+            return self.state == "open" or (self.state == "half_open" and self._probe_in_flight)
+
+    def allow(self):
+        """Return True if a call may go to the model now"""
+        with self._lock:
+            self._check_reset()
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probe_in_flight:
+                # Let exactly one probe through to test recovery
+                self._probe_in_flight = True
+                return True
+            self.rejected_calls += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != "closed":
+                self._transition("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or (
+                self.state == "closed" and self.consecutive_failures >= self.failure_threshold
+            ):
+                self._transition("open")
+
+    def _transition(self, state):
+        now = time.monotonic()
+        if self.state == "open":
+            self.total_open_seconds += now - self.opened_at
+        if state == "open":
+            self.opened_at = now
+        self.transitions.append({
+            "from": self.state,
+            "to": state,
+            "at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        self.state = state
+
+    def stats(self):
+        with self._lock:
+            open_seconds = self.total_open_seconds
+            if self.state == "open":
+                open_seconds += time.monotonic() - self.opened_at
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "rejected_calls": self.rejected_calls,
+                "time_open_seconds": round(open_seconds, 1),
+                "transitions": list(self.transitions)
             }
 
-    def generate_scenario(self):
-        """Generate a new unique scenario or airline trivia question using Gemini"""
-        is_trivia = random.choice([True, False])
-        
-        # Get selected role from session state
-        selected_role = st.session_state.player_role
-        
-        # Add role-specific context to the prompt if a specific role was selected
-        role_context = ""
-        if selected_role != "Any Role":
-            role_context = f"""
-            Focus on scenarios and questions specifically relevant to a {selected_role}.
-            Make sure the situations and questions are realistic and appropriate for this role.
-            Include role-specific terminology and procedures when applicable.
+
+@st.cache_resource
+def get_circuit_breaker():
+    """Shared circuit breaker around the Gemini model for every session in this process"""
+    return CircuitBreaker(Config.CIRCUIT_FAILURE_THRESHOLD, Config.CIRCUIT_RESET_SECONDS)
+
+
+def classify_generation_error(error):
+    """Bucket a failed model call as quota, transient, parse or other"""
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return "quota"
+    if isinstance(error, (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        ConnectionError,
+        TimeoutError
+    )):
+        return "transient"
+    if isinstance(error, json.JSONDecodeError):
+        return "parse"
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    return "other"
+
+
+def retry_delay(cause, attempt):
+    """Exponential backoff with full jitter; quota errors back off from a larger base"""
+    base = Config.GENERATION_QUOTA_BACKOFF_BASE if cause == "quota" else Config.GENERATION_BACKOFF_BASE
+    return random.uniform(0, min(Config.GENERATION_BACKOFF_MAX, base * 2 ** attempt))
+
+
+# Appended to the prompt when a response could not be parsed or repaired
+JSON_ONLY_REMINDER = """
+            Respond with the JSON only: no markdown fences, comments or text before or after it.
             """
-        
-        # Get least used categories
-        used_counts = {cat: len(topics) for cat, topics in st.session_state.topic_categories.items()}
-        min_count = min(used_counts.values())
-        available_categories = [cat for cat, count in used_counts.items() if count == min_count]
-        selected_category = random.choice(available_categories)
-        
-        if is_trivia:
-            prompt = f"""
-            Generate an interesting aviation trivia question for category: {selected_category}
-            {role_context}
 
-            Focus areas for this category:
+
+# Typographic quotes models sometimes emit in place of JSON delimiters
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '„': '"', '‘': "'", '’': "'"})
+
+
+def close_truncated_json(text):
+    """Cut JSON text after its outermost value, dropping trailing commas and closing any truncated tail.
+
+    If the text ends early the partial member is dropped and the open arrays and objects are closed,
+    so a response cut off at MAX_OUTPUT_TOKENS keeps every element that was complete.
+    """
+    out = []
+    stack = []
+    expect_key = []
+    in_string = escaped = string_is_key = False
+    safe_length, safe_stack = 0, []
+
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if not string_is_key:
+                    safe_length, safe_stack = len(out), list(stack)
+            continue
+
+        if char == '"':
+            in_string = True
+            string_is_key = bool(stack) and stack[-1] == '{' and expect_key[-1]
+            out.append(char)
+        elif char in '{[':
+            stack.append(char)
+            expect_key.append(char == '{')
+            out.append(char)
+            safe_length, safe_stack = len(out), list(stack)
+        elif char in '}]':
+            if not stack:
+                break
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+            out.append('}' if stack.pop() == '{' else ']')
+            expect_key.pop()
+            safe_length, safe_stack = len(out), list(stack)
+            if not stack:
+                return "".join(out)
+        elif char == ',':
+            if stack:
+                safe_length, safe_stack = len(out), list(stack)
+                if stack[-1] == '{':
+                    expect_key[-1] = True
+            out.append(char)
+        elif char == ':':
+            if stack:
+                expect_key[-1] = False
+            out.append(char)
+        else:
+            out.append(char)
+
+    # Truncated: keep everything up to the last complete member and close what is still open
+    repaired = "".join(out[:safe_length]).rstrip()
+    if repaired.endswith(','):
+        repaired = repaired[:-1]
+    return repaired + "".join('}' if bracket == '{' else ']' for bracket in reversed(safe_stack))
+
+
+class GenerationMetrics:
+    """Thread-safe counters and timings shared by every generation path in the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, last = self.timings.get(name, (0, 0.0, None))
+            self.timings[name] = (count + 1, total + seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {
+                name: {"count": count, "avg_seconds": round(total / count, 3), "last_seconds": round(last, 3)}
+                for name, (count, total, last) in self.timings.items()
+            }
+            return {"counters": dict(self.counters), "timings": timings, "gauges": dict(self.gauges)}
+
+
+@st.cache_resource
+def get_generation_metrics():
+    """Shared generation metrics for every session in this process"""
+    return GenerationMetrics()
+
+
+class ScenarioPool:
+    """Process-wide pool of ready scenarios keyed by role and category, topped up by a background worker"""
+
+    def __init__(self, depth, retry_delay):
+        self.depth = depth
+        self.retry_delay = retry_delay
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._needs_refill = threading.Condition(self._lock)
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.total_refill_seconds = 0.0
+        self.last_refill_seconds = None
+        self._worker = threading.Thread(target=self._refill_loop, name="scenario-pool-refill", daemon=True)
+        self._worker.start()
+
+    def watch(self, role, categories=SCENARIO_CATEGORIES):
+        """Register role/category keys so the worker keeps them topped up"""
+        with self._lock:
+            for category in categories:
+                self._queues.setdefault((role, category), deque())
+            self._needs_refill.notify()
+
+    def pop(self, role, category):
+        """Return a ready scenario for the key, or None if the pool is empty"""
+        with self._lock:
+            queue = self._queues.setdefault((role, category), deque())
+            if queue:
+                self.hits += 1
+                scenario = queue.popleft()
+            else:
+                self.misses += 1
+                scenario = None
+            self._needs_refill.notify()
+        return scenario
+
+    def offer(self, role, category, scenario):
+        """Return an unused scenario to the pool if its key has room"""
+        with self._lock:
+            queue = self._queues.setdefault((role, category), deque())
+            if len(queue) < self.depth:
+                queue.append(scenario)
+
+    def _next_key(self):
+        """Block until some key is below depth and return the emptiest one with its shortfall"""
+        with self._lock:
+            while True:
+                low = [(len(queue), key) for key, queue in self._queues.items() if len(queue) < self.depth]
+                # Refills are Gemini calls, so none happen when top-up is disabled
+                if low and Config.GEMINI_TOP_UP:
+                    size, key = min(low)
+                    return key, self.depth - size
+                self._needs_refill.wait()
+
+    def _refill_loop(self):
+        while True:
+            (role, category), shortfall = self._next_key()
+            started = time.monotonic()
+            if Config.SCENARIO_BATCH_SIZE > 1 and shortfall > 1:
+                assignments = [(category, random.choice([True, False])) for _ in range(min(shortfall, Config.SCENARIO_BATCH_SIZE))]
+                scenarios = GameManager.request_scenario_batch(role, assignments)
+            else:
+                scenario = GameManager.request_scenario(role, category, random.choice([True, False]), fallback=False)
+                scenarios = [scenario] if scenario is not None else []
+            elapsed = time.monotonic() - started
+            with self._lock:
+                if not scenarios:
+                    self.refill_failures += 1
+                else:
+                    self._queues[(role, category)].extend(scenarios)
+                    self.refills += len(scenarios)
+                    self.total_refill_seconds += elapsed
+                    self.last_refill_seconds = elapsed
+            if not scenarios:
+                # Back off so an API outage does not turn into a tight retry loop
+                time.sleep(self.retry_delay)
+
+    def stats(self):
+        """Snapshot of pool depth, hit rate and refill latency"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self._queues),
+                "ready": sum(len(queue) for queue in self._queues.values()),
+                "target_depth": self.depth,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "refills": self.refills,
+                "refill_failures": self.refill_failures,
+                "avg_refill_seconds": round(self.total_refill_seconds / self.refills, 3) if self.refills else None,
+                "last_refill_seconds": round(self.last_refill_seconds, 3) if self.last_refill_seconds is not None else None
+            }
+
+
+@st.cache_resource
+def get_scenario_pool():
+    """Shared scenario pool for every session in this process"""
+    return ScenarioPool(Config.SCENARIO_POOL_DEPTH, Config.SCENARIO_POOL_RETRY_DELAY)
+
+
+# Static instructions shared by every generation prompt. Keep request-specific text out of it so the
+# prefix is byte-identical across calls and its token count only has to be measured once.
+SCENARIO_PROMPT_PREFIX = """
+            You write questions for SWA Crew Quest, a Southwest Airlines crew training and trivia game.
+            Each item is either an aviation trivia question or a crew scenario.
+
+            For aviation trivia questions:
+            Focus areas for each category:
             - For customer_service: Unique passenger interactions, creative solutions
             - For operations: Airport procedures, flight planning, scheduling
             - For culture: Airline traditions, company values, celebrations
@@ -190,33 +569,9 @@ class GameManager:
             2. Provide three distinct answer options
             3. Include surprising facts in the explanation
             4. Add three fascinating aviation fun facts
-            
-            Return as JSON:
-            {{
-                "scenario": "Your trivia question",
-                "context": "Category context",
-                "category": "{selected_category}",
-                "difficulty": "Easy/Medium/Hard",
-                "points": number 5-15,
-                "options": [
-                    {{"text": "option 1", "is_correct": true/false}},
-                    {{"text": "option 2", "is_correct": true/false}},
-                    {{"text": "option 3", "is_correct": true/false}}
-                ],
-                "explanation": "Detailed explanation",
-                "fun_facts": [
-                    "fact 1",
-                    "fact 2",
-                    "fact 3"
-                ]
-            }}
-            """
-        else:
-            prompt = f"""
-            Generate a unique crew scenario for category: {selected_category}
-            {role_context}
 
-            Focus areas for this category:
+            For crew scenarios:
+            Focus areas for each category:
             - For customer_service: Unique passenger situations, special requests
             - For operations: Unusual flight situations, ground operations
             - For culture: Team building, company values in action
@@ -234,18 +589,20 @@ class GameManager:
             3. Provide three distinct response options
             4. Include practical learning in explanation
             5. Add three fascinating aviation fun facts
-            
-            Return as JSON:
-            {{
-                "scenario": "Your unique scenario",
+
+            Exactly one option must be correct.
+
+            Return each item as JSON:
+            {
+                "scenario": "Your trivia question or unique scenario",
                 "context": "Category context",
-                "category": "{selected_category}",
+                "category": "the requested category",
                 "difficulty": "Easy/Medium/Hard",
                 "points": number 5-15,
                 "options": [
-                    {{"text": "option 1", "is_correct": true/false}},
-                    {{"text": "option 2", "is_correct": true/false}},
-                    {{"text": "option 3", "is_correct": true/false}}
+                    {"text": "option 1", "is_correct": true/false},
+                    {"text": "option 2", "is_correct": true/false},
+                    {"text": "option 3", "is_correct": true/false}
                 ],
                 "explanation": "Detailed explanation",
                 "fun_facts": [
@@ -253,40 +610,2249 @@ class GameManager:
                     "fact 2",
                     "fact 3"
                 ]
-            }}
+            }
             """
 
-        max_retries = 5
-        for attempt in range(max_retries):
+ROLE_CONTEXT_TEMPLATE = string.Template("""
+            Focus on scenarios and questions specifically relevant to a $role.
+            Make sure the situations and questions are realistic and appropriate for this role.
+            Include role-specific terminology and procedures when applicable.
+            """)
+
+SINGLE_PROMPT_TEMPLATE = string.Template("""
+            Generate $request for category: $category
+            $role_context
+            Return exactly one JSON object with "category" set to "$category".
+            """)
+
+BATCH_PROMPT_TEMPLATE = string.Template("""
+            Generate $count distinct items, one for each line below:
+$items
+            $role_context
+            Make every item unique, with no two items alike.
+            Return a JSON array with exactly $count objects in the order above,
+            each with an extra "type" field set to "trivia" or "scenario".
+            """)
+
+# Rough characters-per-token ratio for estimating the short request-specific part of a prompt
+CHARS_PER_TOKEN = 4
+
+
+class PromptBudgetError(ValueError):
+    """Raised when a prompt would not fit in the model context alongside its response"""
+
+
+class PromptTokenCounter:
+    """Counts static prompt prefixes once with model.count_tokens and estimates the variable tail
+
+    While the circuit is open, or for a while after a count failed, the character estimate is served instead.
+    """
+
+    def __init__(self, timeout, retry_seconds):
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._estimates = {}  # text -> (estimate, monotonic time to retry the exact count)
+
+    def count(self, text):
+        with self._lock:
+            if text in self._counts:
+                return self._counts[text]
+            cached = self._estimates.get(text)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+        estimate = len(text) // CHARS_PER_TOKEN + 1
+        if get_circuit_breaker().is_open():
+            return estimate
+        try:
+            tokens = model.count_tokens(text, request_options={"timeout": self.timeout}).total_tokens
+        except Exception:
+            with self._lock:
+                self._estimates[text] = (estimate, time.monotonic() + self.retry_seconds)
+            return estimate
+        with self._lock:
+            self._counts[text] = tokens
+            self._estimates.pop(text, None)
+        return tokens
+
+    def estimate(self, prefix, suffix):
+        """Token estimate for prefix + suffix, exact for the cached prefix"""
+        return self.count(prefix) + len(suffix) // CHARS_PER_TOKEN + 1
+
+
+@st.cache_resource
+def get_prompt_token_counter():
+    """Shared per-template token counts for every session in this process"""
+    return PromptTokenCounter(Config.TOKEN_COUNT_TIMEOUT, Config.TOKEN_COUNT_RETRY_SECONDS)
+
+
+class PromptPrefixCache:
+    """Keeps SCENARIO_PROMPT_PREFIX in a Gemini cached-content object so calls only send the request tail
+
+    Creating and renewing the cache happen on a background thread, so calls never wait on it: until the cache
+    is ready (or while it cannot be created) prompts are sent in full to the regular model.
+    """
+
+    def __init__(self, model_name, ttl_seconds, renew_seconds, retry_seconds, min_tokens, timeout):
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.renew_seconds = renew_seconds
+        self.retry_seconds = retry_seconds
+        self.min_tokens = min_tokens
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._cached_content = None
+        self._cached_model = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._refresh_started = None
+        self._attempt = 0
+        self.prefix_tokens = None
+        self.creations = 0
+        self.renewals = 0
+        self.failures = 0
+        self.last_error = None
+
+    def route(self, prompt):
+        """Return (model, contents) for a prompt, using the cached prefix when the prompt starts with it"""
+        if not prompt.startswith(SCENARIO_PROMPT_PREFIX):
+            return model, prompt
+        cached_model = self._current_model()
+        if cached_model is None:
+            return model, prompt
+        return cached_model, prompt[len(SCENARIO_PROMPT_PREFIX):]
+
+    def _current_model(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refresh_started is not None and now - self._refresh_started > self.timeout:
+                # Give up on a hung create/renew; its late result is ignored
+                self._fail(now, "refresh timed out")
+            too_small = self.prefix_tokens is not None and self.prefix_tokens < self.min_tokens
+            due = self._cached_content is None or now >= self._expires_at - self.renew_seconds
+            if due and not too_small and self._refresh_started is None and now >= self._retry_at:
+                self._attempt += 1
+                self._refresh_started = now
+                threading.Thread(
+                    target=self._refresh, args=(self._attempt,), name="prompt-prefix-cache", daemon=True
+                ).start()
+            if self._cached_content is not None and now < self._expires_at:
+                return self._cached_model
+            return None
+
+    def _fail(self, now, error):
+        # Called with the lock held
+        self._attempt += 1
+        self._refresh_started = None
+        self._cached_content = None
+        self._cached_model = None
+        self._retry_at = now + self.retry_seconds
+        self.failures += 1
+        self.last_error = error
+
+    def _refresh(self, attempt):
+        with self._lock:
+            cached_content = self._cached_content if time.monotonic() < self._expires_at else None
+        try:
+            if cached_content is not None:
+                cached_content.update(ttl=datetime.timedelta(seconds=self.ttl_seconds))
+                cached_model = self._cached_model
+            else:
+                prefix_tokens = get_prompt_token_counter().count(SCENARIO_PROMPT_PREFIX)
+                with self._lock:
+                    self.prefix_tokens = prefix_tokens
+                if prefix_tokens < self.min_tokens:
+                    with self._lock:
+                        if attempt == self._attempt:
+                            self._refresh_started = None
+                            self.last_error = f"prefix is {prefix_tokens} tokens, below the {self.min_tokens} minimum"
+                    return
+                cached_content = caching.CachedContent.create(
+                    model=self.model_name,
+                    display_name="swaquest-prompt-prefix",
+                    contents=[SCENARIO_PROMPT_PREFIX],
+                    ttl=datetime.timedelta(seconds=self.ttl_seconds)
+                )
+                cached_model = genai.GenerativeModel.from_cached_content(
+                    cached_content=cached_content,
+                    generation_config=GENERATION_CONFIG
+                )
+        except Exception as e:
+            with self._lock:
+                if attempt == self._attempt:
+                    self._fail(time.monotonic(), f"{type(e).__name__}: {e}")
+            return
+
+        with self._lock:
+            if attempt != self._attempt:
+                return
+            renewed = cached_content is self._cached_content
+            self._cached_content = cached_content
+            self._cached_model = cached_model
+            self._expires_at = time.monotonic() + self.ttl_seconds
+            self._refresh_started = None
+            if renewed:
+                self.renewals += 1
+            else:
+                self.creations += 1
+
+    def stats(self):
+        with self._lock:
+            active = self._cached_content is not None
+            return {
+                "active": active,
+                "model": self.model_name,
+                "prefix_tokens": self.prefix_tokens,
+                "min_tokens": self.min_tokens,
+                "expires_in_seconds": round(self._expires_at - time.monotonic()) if active else None,
+                "creations": self.creations,
+                "renewals": self.renewals,
+                "failures": self.failures,
+                "last_error": self.last_error
+            }
+
+
+@st.cache_resource
+def get_prompt_prefix_cache():
+    """Shared Gemini context cache for the static prompt prefix"""
+    return PromptPrefixCache(
+        Config.CONTEXT_CACHE_MODEL,
+        Config.CONTEXT_CACHE_TTL_SECONDS,
+        Config.CONTEXT_CACHE_RENEW_SECONDS,
+        Config.CONTEXT_CACHE_RETRY_SECONDS,
+        Config.CONTEXT_CACHE_MIN_TOKENS,
+        Config.MODEL_CALL_TIMEOUT
+    )
+
+
+class ScenarioValidationError(ValueError):
+    """Raised when a scenario payload cannot be served safely"""
+
+
+@dataclass(slots=True)
+class Option:
+    text: str
+    is_correct: bool
+
+
+@dataclass(slots=True)
+class Scenario:
+    """Typed, validated form of the scenario dicts the game serves"""
+    scenario: str
+    context: str
+    category: str
+    difficulty: str
+    points: int
+    options: List[Option]
+    explanation: str
+    fun_facts: List[str]
+    is_trivia: bool = False
+    is_fallback: bool = False
+
+    DIFFICULTIES: ClassVar[Dict[str, str]] = {'easy': 'Easy', 'medium': 'Medium', 'hard': 'Hard'}
+    MIN_POINTS: ClassVar[int] = 5
+    MAX_POINTS: ClassVar[int] = 15
+
+    @classmethod
+    def from_dict(cls, data):
+        """Validate and normalize a scenario dict, raising ScenarioValidationError if it is unusable"""
+        if not isinstance(data, dict):
+            raise ScenarioValidationError("Scenario must be a JSON object")
+
+        text_fields = {}
+        for key in ('scenario', 'context', 'explanation'):
+            value = data.get(key)
+            if not isinstance(value, str) or not value.strip():
+                raise ScenarioValidationError(f"Missing or empty '{key}'")
+            text_fields[key] = value.strip()
+
+        category = data.get('category')
+        if category not in SCENARIO_CATEGORIES:
+            raise ScenarioValidationError(f"Unknown category: {category!r}")
+
+        # Unknown difficulty labels (e.g. "Easy/Medium/Hard" echoed from the prompt) become Medium
+        difficulty = cls.DIFFICULTIES.get(str(data.get('difficulty', '')).strip().lower(), 'Medium')
+
+        points = data.get('points')
+        if isinstance(points, bool) or not isinstance(points, (int, float)):
+            raise ScenarioValidationError(f"Points must be a number, got {points!r}")
+        points = min(cls.MAX_POINTS, max(cls.MIN_POINTS, int(points)))
+
+        raw_options = data.get('options')
+        if not isinstance(raw_options, list) or len(raw_options) < 2:
+            raise ScenarioValidationError("A scenario needs at least two options")
+        options = []
+        seen_texts = set()
+        for raw_option in raw_options:
+            if not isinstance(raw_option, dict) or not isinstance(raw_option.get('text'), str):
+                raise ScenarioValidationError("Each option needs a text")
+            text = raw_option['text'].strip()
+            if not text or text.lower() in seen_texts:
+                raise ScenarioValidationError(f"Empty or duplicate option: {text!r}")
+            seen_texts.add(text.lower())
+            options.append(Option(text, raw_option.get('is_correct') is True))
+        if sum(option.is_correct for option in options) != 1:
+            raise ScenarioValidationError("Exactly one option must be correct")
+
+        fun_facts = data.get('fun_facts', [])
+        if not isinstance(fun_facts, list) or not all(isinstance(fact, str) for fact in fun_facts):
+            raise ScenarioValidationError("fun_facts must be a list of strings")
+
+        return cls(
+            scenario=text_fields['scenario'],
+            context=text_fields['context'],
+            category=category,
+            difficulty=difficulty,
+            points=points,
+            options=options,
+            explanation=text_fields['explanation'],
+            fun_facts=[fact.strip() for fact in fun_facts if fact.strip()],
+            is_trivia=bool(data.get('is_trivia', False)),
+            is_fallback=bool(data.get('is_fallback', False))
+        )
+
+    def to_dict(self):
+        """Plain dict form used in session state, caches and stores"""
+        data = {
+            'scenario': self.scenario,
+            'context': self.context,
+            'category': self.category,
+            'difficulty': self.difficulty,
+            'points': self.points,
+            'options': [{'text': option.text, 'is_correct': option.is_correct} for option in self.options],
+            'explanation': self.explanation,
+            'fun_facts': list(self.fun_facts),
+            'is_trivia': self.is_trivia
+        }
+        if self.is_fallback:
+            data['is_fallback'] = True
+        return data
+
+
+# Response schemas for Gemini structured output, mirroring the JSON shape in the prompts
+OPTION_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "text": {"type": "STRING"},
+        "is_correct": {"type": "BOOLEAN"}
+    },
+    "required": ["text", "is_correct"]
+}
+
+SCENARIO_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "scenario": {"type": "STRING"},
+        "context": {"type": "STRING"},
+        "category": {"type": "STRING"},
+        "difficulty": {"type": "STRING"},
+        "points": {"type": "INTEGER"},
+        "options": {"type": "ARRAY", "items": OPTION_RESPONSE_SCHEMA},
+        "explanation": {"type": "STRING"},
+        "fun_facts": {"type": "ARRAY", "items": {"type": "STRING"}}
+    },
+    "required": ["scenario", "context", "category", "difficulty", "points", "options", "explanation", "fun_facts"]
+}
+
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(SCENARIO_RESPONSE_SCHEMA["properties"], type={"type": "STRING"}),
+        "required": ["type"] + SCENARIO_RESPONSE_SCHEMA["required"]
+    }
+}
+
+
+class ScenarioCache:
+    """In-memory scenario cache shared across sessions, keyed by (role, category, is_trivia) with LRU and TTL eviction"""
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # (key, content_hash) -> (expires_at, size, scenario), least recently used first
+        self._entries = OrderedDict()
+        # key -> content hashes cached for it
+        self._by_key = {}
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lru_evictions = 0
+        self.ttl_evictions = 0
+
+    def put(self, role, category, scenario):
+        """Cache a generated scenario, evicting least recently used entries beyond the caps"""
+        key = (role, category, bool(scenario.get('is_trivia')))
+        content_hash = scenario_content_hash(scenario)
+        size = len(json.dumps(scenario))
+        with self._lock:
+            if (key, content_hash) in self._entries:
+                return
+            self._entries[(key, content_hash)] = (time.monotonic() + self.ttl_seconds, size, scenario)
+            self._by_key.setdefault(key, set()).add(content_hash)
+            self.bytes_used += size
+            while len(self._entries) > self.max_entries or self.bytes_used > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.lru_evictions += 1
+
+    def get(self, role, category, is_trivia, seen=()):
+        """Return a copy of a fresh cached scenario whose hash is not in seen, or None"""
+        key = (role, category, bool(is_trivia))
+        now = time.monotonic()
+        with self._lock:
+            for content_hash in list(self._by_key.get(key, ())):
+                expires_at, _, scenario = self._entries[(key, content_hash)]
+                if expires_at <= now:
+                    self._remove((key, content_hash))
+                    self.ttl_evictions += 1
+                elif content_hash not in seen:
+                    self._entries.move_to_end((key, content_hash))
+                    self.hits += 1
+                    return json.loads(json.dumps(scenario))
+            self.misses += 1
+        return None
+
+    def _remove(self, entry_key):
+        key, content_hash = entry_key
+        _, size, _ = self._entries.pop(entry_key)
+        self.bytes_used -= size
+        hashes = self._by_key[key]
+        hashes.discard(content_hash)
+        if not hashes:
+            del self._by_key[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "keys": len(self._by_key),
+                "bytes": self.bytes_used,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "lru_evictions": self.lru_evictions,
+                "ttl_evictions": self.ttl_evictions
+            }
+
+
+@st.cache_resource
+def get_scenario_cache():
+    """Shared in-memory scenario cache for every session in this process"""
+    return ScenarioCache(Config.SCENARIO_CACHE_MAX_ENTRIES, Config.SCENARIO_CACHE_MAX_BYTES, Config.SCENARIO_CACHE_TTL_SECONDS)
+
+
+# Bump when the bank file layout changes; the app ignores banks built for another version
+SCENARIO_BANK_VERSION = 2
+BANK_MAGIC = b"SWAB"
+# magic, version, record/key/string counts, built_at and model string ids, section offsets
+BANK_HEADER = struct.Struct("<4sHxxIIIIIQQQ")
+# role, category, difficulty, points, correct option, option count, fun fact count, is_trivia,
+# then string ids for scenario, context, explanation, first option and first fun fact
+BANK_RECORD = struct.Struct("<IIBBBBBBxxIIIII")
+BANK_RECORD_TRIVIA_BYTE = 13
+# role, category, first record, record count; records are sorted so each key is one contiguous run
+BANK_KEY = struct.Struct("<IIII")
+BANK_OFFSET = struct.Struct("<Q")
+BANK_DIFFICULTIES = list(Scenario.DIFFICULTIES.values())
+
+
+def write_scenario_bank(path, scenarios, model_name=""):
+    """Write validated scenarios (each with a 'role') as a binary bank file, atomically"""
+    strings = []
+    interned = {}
+
+    def intern(text):
+        if text not in interned:
+            interned[text] = len(strings)
+            strings.append(text)
+        return interned[text]
+
+    def append_run(texts):
+        # Options and fun facts take consecutive string ids so a record only stores the first
+        first = len(strings)
+        strings.extend(texts)
+        return first
+
+    built_at = intern(datetime.datetime.now().isoformat(timespec='seconds'))
+    model_id = intern(model_name)
+    ordered = sorted(scenarios, key=lambda scenario: (scenario['role'], scenario['category']))
+
+    records = bytearray()
+    keys = []
+    for index, scenario in enumerate(ordered):
+        role, category = intern(scenario['role']), intern(scenario['category'])
+        if not keys or keys[-1][:2] != [role, category]:
+            keys.append([role, category, index, 0])
+        keys[-1][3] += 1
+        options = scenario['options']
+        records += BANK_RECORD.pack(
+            role,
+            category,
+            BANK_DIFFICULTIES.index(scenario['difficulty']),
+            scenario['points'],
+            next(i for i, option in enumerate(options) if option['is_correct']),
+            len(options),
+            len(scenario['fun_facts']),
+            bool(scenario.get('is_trivia')),
+            intern(scenario['scenario']),
+            intern(scenario['context']),
+            intern(scenario['explanation']),
+            append_run([option['text'] for option in options]),
+            append_run(scenario['fun_facts'])
+        )
+
+    records_offset = BANK_HEADER.size
+    keys_offset = records_offset + len(records)
+    strings_offset = keys_offset + BANK_KEY.size * len(keys)
+    encoded = [text.encode('utf-8') for text in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as bank_file:
+        bank_file.write(BANK_HEADER.pack(
+            BANK_MAGIC, SCENARIO_BANK_VERSION, len(ordered), len(keys), len(strings), built_at, model_id,
+            records_offset, keys_offset, strings_offset
+        ))
+        bank_file.write(records)
+        for key in keys:
+            bank_file.write(BANK_KEY.pack(*key))
+        for offset in offsets:
+            bank_file.write(BANK_OFFSET.pack(offset))
+        bank_file.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+
+
+class ScenarioBank:
+    """Read-only, memory-mapped bank of precompiled scenarios; pages are shared by every process mapping the file
+
+    Opening reads only the header and the per-(role, category) index, so startup does not grow with the bank.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.built_at = None
+        self.size = 0
+        self.load_error = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._map = None
+        try:
+            with open(path, 'rb') as bank_file:
+                self._map = mmap.mmap(bank_file.fileno(), 0, access=mmap.ACCESS_READ)
+            header = BANK_HEADER.unpack_from(self._map, 0)
+        except FileNotFoundError:
+            self.load_error = "missing"
+            return
+        except (OSError, ValueError, struct.error) as e:
+            self.load_error = f"unreadable: {e}"
+            return
+        magic, version, record_count, key_count, string_count, built_at, model_id, records_offset, keys_offset, \
+            strings_offset = header
+        if magic != BANK_MAGIC or version != SCENARIO_BANK_VERSION:
+            self.load_error = f"version {version} != {SCENARIO_BANK_VERSION}"
+            return
+
+        self.version = version
+        self.size = record_count
+        self._records_offset = records_offset
+        self._strings_offset = strings_offset
+        self._blob_offset = strings_offset + BANK_OFFSET.size * (string_count + 1)
+        self.built_at = self._string(built_at)
+        for i in range(key_count):
+            role, category, first, count = BANK_KEY.unpack_from(self._map, keys_offset + BANK_KEY.size * i)
+            self._keys[(self._string(role), self._string(category))] = (first, count)
+
+    def _string(self, string_id):
+        start, end = struct.unpack_from("<QQ", self._map, self._strings_offset + BANK_OFFSET.size * string_id)
+        return self._map[self._blob_offset + start:self._blob_offset + end].decode('utf-8')
+
+    def is_trivia_at(self, index):
+        return bool(self._map[self._records_offset + BANK_RECORD.size * index + BANK_RECORD_TRIVIA_BYTE])
+
+    def scenario_at(self, index):
+        """Decode the scenario stored at a record index (O(1))"""
+        role, category, difficulty, points, correct, option_count, fact_count, is_trivia, \
+            text, context, explanation, first_option, first_fact = BANK_RECORD.unpack_from(
+                self._map, self._records_offset + BANK_RECORD.size * index
+            )
+        return {
+            'scenario': self._string(text),
+            'context': self._string(context),
+            'category': self._string(category),
+            'difficulty': BANK_DIFFICULTIES[difficulty],
+            'points': points,
+            'options': [
+                {'text': self._string(first_option + i), 'is_correct': i == correct}
+                for i in range(option_count)
+            ],
+            'explanation': self._string(explanation),
+            'fun_facts': [self._string(first_fact + i) for i in range(fact_count)],
+            'is_trivia': bool(is_trivia)
+        }
+
+    def scenarios(self):
+        """Every scenario in the bank with its 'role', in file order"""
+        for (role, _), (first, count) in self._keys.items():
+            for index in range(first, first + count):
+                yield dict(self.scenario_at(index), role=role)
+
+    def pick(self, role, category, is_trivia, seen=()):
+        """Return a random unseen bank scenario, preferring the requested type, or None"""
+        first, count = self._keys.get((role, category)) or self._keys.get(("Any Role", category)) or (0, 0)
+        match = None
+        if count:
+            start = random.randrange(count)
+            for i in range(count):
+                index = first + (start + i) % count
+                # Check the type from the fixed-width record before decoding any strings
+                if match is not None and self.is_trivia_at(index) != is_trivia:
+                    continue
+                scenario = self.scenario_at(index)
+                if scenario_content_hash(scenario) in seen:
+                    continue
+                match = scenario
+                if scenario['is_trivia'] == is_trivia:
+                    break
+        with self._lock:
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return match
+
+    def stats(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "version": self.version,
+                "built_at": self.built_at,
+                "scenarios": self.size,
+                "keys": len(self._keys),
+                "load_error": self.load_error,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+@st.cache_resource
+def get_scenario_bank():
+    """Precompiled scenario bank, loaded once per process"""
+    return ScenarioBank(Config.SCENARIO_BANK_PATH)
+
+
+class ScenarioStore:
+    """SQLite-backed cache of validated scenarios that survives restarts and is shared by all sessions"""
+
+    REUSE_POLICIES = ("per_player", "once", "always")
+
+    def __init__(self, path, max_rows, reuse_policy):
+        if reuse_policy not in self.REUSE_POLICIES:
+            raise ValueError(f"Unknown scenario reuse policy: {reuse_policy}")
+        self.max_rows = max_rows
+        self.reuse_policy = reuse_policy
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS scenarios (
+                    id INTEGER PRIMARY KEY,
+                    content_hash TEXT NOT NULL UNIQUE,
+                    role TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    difficulty TEXT NOT NULL,
+                    is_trivia INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    serve_count INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_scenarios_lookup
+                    ON scenarios (role, category, is_trivia, difficulty);
+                CREATE TABLE IF NOT EXISTS served (
+                    player TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    served_at REAL NOT NULL,
+                    PRIMARY KEY (player, content_hash)
+                );
+            """)
+
+    def save(self, role, scenario):
+        """Persist a validated scenario, ignoring duplicates and template fallbacks"""
+        if scenario.get('is_fallback'):
+            return
+        content_hash = scenario_content_hash(scenario)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO scenarios "
+                "(content_hash, role, category, difficulty, is_trivia, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    content_hash,
+                    role,
+                    scenario['category'],
+                    str(scenario.get('difficulty', 'Medium')),
+                    int(bool(scenario.get('is_trivia'))),
+                    json.dumps(scenario),
+                    time.time()
+                )
+            )
+            self._evict()
+
+    def fetch(self, role, category, player, is_trivia=None, seen=()):
+        """Return a stored scenario allowed by the reuse policy and not in seen, or None"""
+        query = "SELECT payload FROM scenarios WHERE role = ? AND category = ?"
+        params = [role, category]
+        if is_trivia is not None:
+            query += " AND is_trivia = ?"
+            params.append(int(is_trivia))
+        if seen:
+            query += f" AND content_hash NOT IN ({', '.join('?' for _ in seen)})"
+            params.extend(seen)
+        if self.reuse_policy == "per_player":
+            query += " AND content_hash NOT IN (SELECT content_hash FROM served WHERE player = ?)"
+            params.append(player)
+        elif self.reuse_policy == "once":
+            query += " AND serve_count = 0"
+        query += " ORDER BY serve_count, RANDOM() LIMIT 1"
+
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def mark_served(self, player, scenario):
+        """Record that a player has been shown a scenario, whatever source it came from"""
+        if scenario.get('is_fallback'):
+            return
+        content_hash = scenario_content_hash(scenario)
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE scenarios SET serve_count = serve_count + 1 WHERE content_hash = ?", (content_hash,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO served (player, content_hash, served_at) VALUES (?, ?, ?)",
+                (player, content_hash, time.time())
+            )
+
+    def _evict(self):
+        """Drop the most served, then oldest, rows once the store exceeds its size cap"""
+        excess = self._conn.execute("SELECT COUNT(*) FROM scenarios").fetchone()[0] - self.max_rows
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM scenarios WHERE id IN "
+            "(SELECT id FROM scenarios ORDER BY serve_count DESC, created_at ASC LIMIT ?)",
+            (excess,)
+        )
+        self._conn.execute("DELETE FROM served WHERE content_hash NOT IN (SELECT content_hash FROM scenarios)")
+
+    def stats(self):
+        with self._lock:
+            rows, served = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(serve_count), 0) FROM scenarios").fetchone()
+        return {"rows": rows, "max_rows": self.max_rows, "times_served": served, "reuse_policy": self.reuse_policy}
+
+
+@st.cache_resource
+def get_scenario_store():
+    """Shared on-disk scenario cache for every session in this process"""
+    return ScenarioStore(Config.SCENARIO_STORE_PATH, Config.SCENARIO_STORE_MAX_ROWS, Config.SCENARIO_REUSE_POLICY)
+
+
+# Leaderboard time windows and their sidebar labels
+LEADERBOARD_WINDOWS = {"all_time": "All time", "day": "Today", "week": "This week", "month": "This month"}
+
+
+def leaderboard_window_key(window, timestamp):
+    """Label of the day/week/month containing timestamp, or "" for all time"""
+    moment = datetime.datetime.fromtimestamp(timestamp)
+    if window == "day":
+        return moment.strftime("%Y-%m-%d")
+    if window == "week":
+        return moment.strftime("%G-W%V")
+    if window == "month":
+        return moment.strftime("%Y-%m")
+    return ""
+
+
+def leaderboard_window_start(window, timestamp):
+    """Start of the day/week/month containing timestamp as a Unix time, or 0 for all time"""
+    moment = datetime.datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    if window == "day":
+        return moment.timestamp()
+    if window == "week":
+        return (moment - datetime.timedelta(days=moment.weekday())).timestamp()
+    if window == "month":
+        return moment.replace(day=1).timestamp()
+    return 0.0
+
+
+class ScoreHistogram:
+    """Mergeable histogram of bounded integer scores with running prefix counts, so percentiles are O(1)"""
+
+    def __init__(self, max_score):
+        self.max_score = max_score
+        self.counts = [0] * (max_score + 1)
+        self.total = 0
+        self._below = [0] * (max_score + 2)
+
+    def _clamp(self, score):
+        return min(max(int(score), 0), self.max_score)
+
+    def add(self, score, count=1):
+        score = self._clamp(score)
+        self.counts[score] += count
+        self.total += count
+        # The score range is small (ROUNDS_PER_GAME * MAX_POINTS), so updating the prefix counts is cheap
+        for i in range(score + 1, len(self._below)):
+            self._below[i] += count
+
+    def remove(self, score):
+        self.add(score, -1)
+
+    def merge(self, other):
+        for score, count in enumerate(other.counts):
+            if count:
+                self.add(score, count)
+
+    def below(self, score):
+        """Number of recorded scores strictly lower than score"""
+        return self._below[self._clamp(score)]
+
+    def above(self, score):
+        """Number of recorded scores strictly higher than score"""
+        return self.total - self._below[self._clamp(score) + 1]
+
+    def percentile(self, score, own_score=None):
+        """Share (0-100) of the recorded scores that score beats, leaving out the caller's own recorded score"""
+        below, others = self.below(score), self.total
+        if own_score is not None:
+            others -= 1
+            if self._clamp(own_score) < self._clamp(score):
+                below -= 1
+        if others <= 0:
+            return 100
+        return min(100, max(0, round(100 * below / others)))
+
+
+class LeaderboardPartition:
+    """Best score per player in one partition: a sorted list for top-K and a histogram for O(1) rank lookups"""
+
+    def __init__(self, max_score):
+        self._best = {}
+        self._ranked = []
+        self.histogram = ScoreHistogram(max_score)
+
+    def add(self, player, score, played_at):
+        best = self._best.get(player)
+        if best is not None:
+            if score <= best[0]:
+                return
+            del self._ranked[bisect.bisect_left(self._ranked, (-best[0], best[1], player))]
+            self.histogram.remove(best[0])
+        self._best[player] = (score, played_at)
+        bisect.insort(self._ranked, (-score, played_at, player))
+        self.histogram.add(score)
+
+    def load(self, bests):
+        """Fill an empty partition from (player, best score, played_at) rows with one sort"""
+        for player, score, played_at in bests:
+            self._best[player] = (score, played_at)
+            self.histogram.add(score)
+        self._ranked = sorted((-score, played_at, player) for player, (score, played_at) in self._best.items())
+
+    def top(self, limit):
+        return self._ranked[:limit]
+
+    def best(self, player):
+        """A player's best score in this partition, or None"""
+        best = self._best.get(player)
+        return best[0] if best is not None else None
+
+    def standing(self, player):
+        """Rank, player count and share of other players beaten for a player's best score, or None"""
+        best = self._best.get(player)
+        if best is None:
+            return None
+        score = best[0]
+        return {
+            "score": score,
+            "rank": self.histogram.above(score) + 1,
+            "players": self.histogram.total,
+            "beaten": self.histogram.below(score),
+            "percentile": self.histogram.percentile(score, own_score=score),
+        }
+
+
+class Leaderboard:
+    """Leaderboard shared by every session, stored in SQLite (WAL mode) and partitioned in memory by role,
+    group tag and day/week/month window"""
+
+    def __init__(self, path, top_k, refresh_seconds, max_score):
+        self.top_k = top_k
+        self.refresh_seconds = refresh_seconds
+        self.max_score = max_score
+        self._lock = threading.Lock()
+        # WAL lets sessions in other processes read while one writes; writers wait on the busy timeout
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS scores (
+                    id INTEGER PRIMARY KEY,
+                    player TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    score INTEGER NOT NULL,
+                    played_at REAL NOT NULL
+                );
+                DROP INDEX IF EXISTS idx_scores_score;
+                CREATE INDEX IF NOT EXISTS idx_scores_played_at ON scores (played_at);
+                CREATE TABLE IF NOT EXISTS score_groups (
+                    score_id INTEGER NOT NULL REFERENCES scores (id),
+                    tag TEXT NOT NULL,
+                    PRIMARY KEY (score_id, tag)
+                );
+            """)
+        self._partitions = {}
+        self._windows = {}
+        self._last_id = 0
+        self.writes = 0
+        self.syncs = 0
+        self._load()
+
+    def _current_windows(self):
+        now = time.time()
+        return {window: leaderboard_window_key(window, now) for window in LEADERBOARD_WINDOWS}
+
+    def _load(self):
+        # Build every current partition from per-player best scores instead of replaying each stored game
+        self._windows = self._current_windows()
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM scores").fetchone()[0]
+        now = time.time()
+        bests = {}
+        for window, window_key in self._windows.items():
+            params = (self._last_id, leaderboard_window_start(window, now))
+            # SQLite returns played_at from the row that holds MAX(score)
+            queries = (
+                ("SELECT 'all', '', player, MAX(score), played_at FROM scores "
+                 "WHERE id <= ? AND played_at >= ? GROUP BY player"),
+                ("SELECT 'role', role, player, MAX(score), played_at FROM scores "
+                 "WHERE id <= ? AND played_at >= ? GROUP BY role, player"),
+                ("SELECT 'group', g.tag, s.player, MAX(s.score), s.played_at "
+                 "FROM scores s JOIN score_groups g ON g.score_id = s.id "
+                 "WHERE s.id <= ? AND s.played_at >= ? GROUP BY g.tag, s.player"),
+            )
+            for query in queries:
+                for scope, value, player, score, played_at in self._conn.execute(query, params):
+                    bests.setdefault((scope, value, window, window_key), []).append((player, score, played_at))
+        self._partitions = {}
+        for key, rows in bests.items():
+            self._partitions[key] = LeaderboardPartition(self.max_score)
+            self._partitions[key].load(rows)
+        self._synced_at = time.monotonic()
+        self.syncs += 1
+
+    def _sync(self):
+        # Apply rows written since the last sync, by this process or any other, to the partitions
+        windows = self._current_windows()
+        if windows != self._windows:
+            # A day, week or month rolled over: drop partitions for windows that have closed
+            current = set(windows.items())
+            self._partitions = {key: part for key, part in self._partitions.items() if key[2:] in current}
+            self._windows = windows
+        rows = self._conn.execute(
+            "SELECT s.id, s.player, s.role, s.score, s.played_at, group_concat(g.tag, char(31)) "
+            "FROM scores s LEFT JOIN score_groups g ON g.score_id = s.id "
+            "WHERE s.id > ? GROUP BY s.id ORDER BY s.id",
+            (self._last_id,)
+        ).fetchall()
+        for score_id, player, role, score, played_at, tags in rows:
+            scopes = [("all", ""), ("role", role)] + [("group", tag) for tag in (tags.split("\x1f") if tags else [])]
+            for window, current_key in windows.items():
+                window_key = leaderboard_window_key(window, played_at)
+                if window_key != current_key:
+                    continue
+                for scope in scopes:
+                    key = scope + (window, window_key)
+                    if key not in self._partitions:
+                        self._partitions[key] = LeaderboardPartition(self.max_score)
+                    self._partitions[key].add(player, score, played_at)
+            self._last_id = score_id
+        self._synced_at = time.monotonic()
+        self.syncs += 1
+
+    def _partition(self, role, group, window):
+        # Scores from other processes show up once the refresh interval has passed
+        if time.monotonic() - self._synced_at > self.refresh_seconds:
+            self._sync()
+        scope = ("group", group) if group else ("role", role) if role else ("all", "")
+        return self._partitions.get(scope + (window, self._windows[window]))
+
+    def record(self, player, role, score, groups=()):
+        """Store a finished game's score under its role and group tags and update every partition it belongs to"""
+        with self._lock:
+            with self._conn:
+                cursor = self._conn.execute(
+                    "INSERT INTO scores (player, role, score, played_at) VALUES (?, ?, ?, ?)",
+                    (player, role, score, time.time())
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO score_groups (score_id, tag) VALUES (?, ?)",
+                    [(cursor.lastrowid, tag) for tag in groups if tag]
+                )
+            self.writes += 1
+            self._sync()
+
+    def top(self, limit=None, role=None, group=None, window="all_time"):
+        """Best score per player in a partition, highest first, capped at top_k"""
+        limit = min(limit or self.top_k, self.top_k)
+        with self._lock:
+            partition = self._partition(role, group, window)
+            entries = partition.top(limit) if partition is not None else []
+        return [
+            {
+                "name": player,
+                "score": -negative_score,
+                "date": datetime.datetime.fromtimestamp(played_at).strftime("%Y-%m-%d %H:%M")
+            }
+            for negative_score, played_at, player in entries
+        ]
+
+    def standing(self, player, role=None, group=None, window="all_time"):
+        """A player's rank and percentile in a partition, whether or not they are in its top K"""
+        with self._lock:
+            partition = self._partition(role, group, window)
+            return partition.standing(player) if partition is not None else None
+
+    def percentile(self, score, role=None, group=None, window="all_time", player=None):
+        """Share of players in a partition whose best score is below score, in O(1), or None for an empty partition;
+        when player is given, their own entry is left out"""
+        with self._lock:
+            partition = self._partition(role, group, window)
+            if partition is None:
+                return None
+            own_score = partition.best(player) if player is not None else None
+            return partition.histogram.percentile(score, own_score=own_score)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "top_k": self.top_k,
+                "writes": self.writes,
+                "syncs": self.syncs,
+                "partitions": len(self._partitions),
+            }
+
+
+@st.cache_resource
+def get_leaderboard():
+    """Shared leaderboard for every session in this process"""
+    return Leaderboard(
+        Config.LEADERBOARD_PATH,
+        Config.LEADERBOARD_TOP_K,
+        Config.LEADERBOARD_REFRESH_SECONDS,
+        Config.ROUNDS_PER_GAME * Scenario.MAX_POINTS
+    )
+
+
+class RoundHistoryStore:
+    """Append-only SQLite store of answered rounds; appends are buffered and written in batches by a background thread"""
+
+    COLUMNS = (
+        "game_id", "played_at", "player", "role", "base", "round", "category", "is_trivia", "context", "difficulty",
+        "scenario", "player_choice", "correct_answer", "is_correct", "points", "possible_points", "explanation"
+    )
+
+    def __init__(self, path, batch_size, flush_seconds, write_attempts, retry_base):
+        self.path = path
+        self.spill_path = path + ".unwritten.jsonl"
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.write_attempts = max(1, write_attempts)
+        self.retry_base = retry_base
+        self._queue = queue.Queue()
+        self._read_lock = threading.Lock()
+        self._read_conn = self._connect()
+        with self._read_conn:
+            self._read_conn.executescript("""
+                CREATE TABLE IF NOT EXISTS rounds (
+                    id INTEGER PRIMARY KEY,
+                    game_id TEXT NOT NULL,
+                    played_at REAL NOT NULL,
+                    player TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    base TEXT NOT NULL,
+                    round INTEGER NOT NULL,
+                    category TEXT NOT NULL,
+                    is_trivia INTEGER NOT NULL,
+                    context TEXT NOT NULL,
+                    difficulty TEXT NOT NULL,
+                    scenario TEXT NOT NULL,
+                    player_choice TEXT NOT NULL,
+                    correct_answer TEXT NOT NULL,
+                    is_correct INTEGER NOT NULL,
+                    points INTEGER NOT NULL,
+                    possible_points INTEGER NOT NULL,
+                    explanation TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_rounds_player ON rounds (player, played_at);
+                CREATE INDEX IF NOT EXISTS idx_rounds_role ON rounds (role, played_at);
+                CREATE INDEX IF NOT EXISTS idx_rounds_category ON rounds (category, played_at);
+                CREATE INDEX IF NOT EXISTS idx_rounds_played_at ON rounds (played_at);
+            """)
+        self.appended = 0
+        self.written = 0
+        self.batches = 0
+        self.write_retries = 0
+        self.write_failures = 0
+        self.spilled = 0
+        self.lost = 0
+        self.last_error = None
+        self._writer = threading.Thread(target=self._write_loop, name="round-history-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, record):
+        """Queue one round record for writing; never blocks on disk"""
+        self._queue.put(tuple(record[column] for column in self.COLUMNS))
+        self.appended += 1
+
+    def _write_loop(self):
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        insert = f"INSERT INTO rounds ({', '.join(self.COLUMNS)}) VALUES ({placeholders})"
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            # Gather more rows until the batch is full or the oldest row has waited flush_seconds
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write_batch(conn, insert, batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, conn, insert, batch):
+        """Insert one batch, retrying with backoff; a batch that keeps failing is spilled to a JSONL file"""
+        for attempt in range(self.write_attempts):
+            if attempt:
+                self.write_retries += 1
+                time.sleep(self.retry_base * 2 ** (attempt - 1))
             try:
-                response = model.generate_content(prompt)
-                scenario_str = response.text.strip()
-                scenario_str = scenario_str.replace("```json", "").replace("```", "").strip()
-                scenario = json.loads(scenario_str)
-                
-                # Add the scenario to its category
-                category = scenario.get('category', selected_category)
-                st.session_state.topic_categories[category].append(scenario['scenario'])
-                
-                # Randomly shuffle options
-                options = scenario['options']
-                random.shuffle(options)
-                scenario['options'] = options
-                
-                # Add type flag to scenario
-                scenario['is_trivia'] = is_trivia
+                with conn:
+                    conn.executemany(insert, batch)
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except sqlite3.Error as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+        self.write_failures += 1
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill:
+                for row in batch:
+                    spill.write(json.dumps(dict(zip(self.COLUMNS, row))) + "\n")
+            self.spilled += len(batch)
+        except OSError as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            self.lost += len(batch)
+
+    def flush(self):
+        """Block until every queued round has been written"""
+        self._queue.join()
+
+    def query(self, player=None, role=None, category=None, since=None, until=None, limit=1000):
+        """Rounds matching the given filters, newest first; since/until are datetimes"""
+        clauses, params = [], []
+        for column, value in (("player", player), ("role", role), ("category", category)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("played_at >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            clauses.append("played_at < ?")
+            params.append(until.timestamp())
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._read_lock:
+            cursor = self._read_conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM rounds {where} ORDER BY played_at DESC LIMIT ?",
+                params + [limit]
+            )
+            return [dict(zip(self.COLUMNS, row)) for row in cursor.fetchall()]
+
+    def stats(self):
+        return {
+            "appended": self.appended,
+            "written": self.written,
+            "batches": self.batches,
+            "queued": self._queue.qsize(),
+            "write_retries": self.write_retries,
+            "write_failures": self.write_failures,
+            "spilled": self.spilled,
+            "lost": self.lost,
+            "last_error": self.last_error,
+        }
+
+
+@st.cache_resource
+def get_round_history():
+    """Shared round history store for every session in this process"""
+    return RoundHistoryStore(
+        Config.HISTORY_PATH,
+        Config.HISTORY_BATCH_SIZE,
+        Config.HISTORY_FLUSH_SECONDS,
+        Config.HISTORY_WRITE_ATTEMPTS,
+        Config.HISTORY_RETRY_BASE
+    )
+
+
+@st.cache_resource
+def get_generation_executor():
+    """Shared worker threads for background scenario generation
+
+    The engine limits Gemini calls, but parsing, validation and retry backoff sleeps are synchronous, so each
+    in-progress request still needs a thread; most of them wait on the engine, hence the pool is sized separately.
+    """
+    return ThreadPoolExecutor(max_workers=Config.GENERATION_WORKERS, thread_name_prefix="scenario-gen")
+
+
+@st.cache_resource
+def get_foreground_executor():
+    """Worker threads for rounds a player is waiting on, so they never queue behind background work"""
+    return ThreadPoolExecutor(max_workers=Config.FOREGROUND_WORKERS, thread_name_prefix="scenario-live")
+
+
+_generation_context = threading.local()
+
+
+def submit_generation(executor, fn, *args):
+    """Submit generation work, recording the submission time so queue wait includes time spent waiting for a worker"""
+    submitted = time.monotonic()
+
+    def run():
+        _generation_context.submitted = submitted
+        try:
+            return fn(*args)
+        finally:
+            _generation_context.submitted = None
+
+    return executor.submit(run)
+
+
+class TokenBucket:
+    """Per-minute allowance refilled continuously; used only on the engine loop, so it takes no lock"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def delay(self, amount):
+        """Seconds until amount is available, 0 when it already is or the bucket is unlimited"""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, min(amount, self.capacity) - self.available) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity > 0:
+            self.available -= min(amount, self.capacity)
+
+    def settle(self, amount):
+        """Charge (or refund, when negative) the difference between an estimate and actual use"""
+        if self.capacity > 0:
+            self._refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+class GenerationEngine:
+    """Asyncio event loop on its own thread that runs every Gemini call under one concurrency and rate limit"""
+
+    def __init__(self, max_in_flight, requests_per_minute, tokens_per_minute):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self._waiting = {True: 0, False: 0}
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._loop = asyncio.new_event_loop()
+        self._admission = None
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="generation-engine", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._admission = asyncio.Condition()
+        ready.set()
+        self._loop.run_forever()
+
+    async def _admit(self, tokens, foreground):
+        # Counters and buckets are only touched on the loop thread, so they need no lock
+        async with self._admission:
+            self._waiting[foreground] += 1
+            try:
+                while True:
+                    delay = max(self._request_bucket.delay(1), self._token_bucket.delay(tokens))
+                    # Background calls also wait while any foreground call is queued
+                    if delay <= 0 and self.in_flight < self.max_in_flight and (foreground or not self._waiting[True]):
+                        break
+                    try:
+                        await asyncio.wait_for(self._admission.wait(), delay or None)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting[foreground] -= 1
+                self._admission.notify_all()
+            self._request_bucket.take(1)
+            self._token_bucket.take(tokens)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def _release(self):
+        async with self._admission:
+            self.in_flight -= 1
+            self._admission.notify_all()
+
+    async def _generate(self, target_model, contents, chunks, timeout, tokens, foreground, queued, kwargs):
+        await self._admit(tokens, foreground)
+        priority = "foreground" if foreground else "background"
+        get_generation_metrics().observe(f"queue_wait_{priority}", time.monotonic() - queued)
+        try:
+            response = await asyncio.wait_for(self._call(target_model, contents, chunks, kwargs), timeout)
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            await self._release()
+        self.completed += 1
+        # The bucket was charged the prompt estimate; settle it against the usage Gemini reports
+        usage_metadata = getattr(response, 'usage_metadata', None)
+        if usage_metadata is not None and usage_metadata.total_token_count:
+            self._token_bucket.settle(usage_metadata.total_token_count - tokens)
+        return response
+
+    @staticmethod
+    async def _call(target_model, contents, chunks, kwargs):
+        response = await target_model.generate_content_async(contents, stream=chunks is not None, **kwargs)
+        if chunks is not None:
+            async for chunk in response:
+                chunks.append(chunk.text)
+        return response
+
+    def generate(self, target_model, contents, chunks=None, timeout=None, tokens=0, foreground=False, **kwargs):
+        """Run one Gemini call on the engine loop and block until it finishes; streamed text is appended to chunks"""
+        # The first call of a submitted task counts its queue wait from submission, later ones (retries) from here
+        queued = getattr(_generation_context, 'submitted', None) or time.monotonic()
+        _generation_context.submitted = None
+        future = asyncio.run_coroutine_threadsafe(
+            self._generate(target_model, contents, chunks, timeout, tokens, foreground, queued, kwargs), self._loop
+        )
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Gemini call exceeded {timeout} seconds") from None
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "queued_foreground": self._waiting[True],
+            "queued_background": self._waiting[False],
+            "requests_available": round(self._request_bucket.available, 1),
+            "tokens_available": round(self._token_bucket.available),
+        }
+
+
+@st.cache_resource
+def get_generation_engine():
+    """Shared generation engine for every session in this process"""
+    return GenerationEngine(
+        Config.MAX_IN_FLIGHT_REQUESTS, Config.RATE_LIMIT_REQUESTS_PER_MINUTE, Config.RATE_LIMIT_TOKENS_PER_MINUTE
+    )
+
+
+class RequestCoalescer:
+    """Single-flight layer: concurrent live requests for the same role, category and type share one Gemini call"""
+
+    def __init__(self, window, max_waiters):
+        self.window = window
+        self.max_waiters = max_waiters
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.flights = 0
+        self.joined = 0
+        self.delivered = 0
+
+    def join(self, key):
+        """Join an open flight for key, returning a Future for one scenario, or None when there is none"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or len(flight["waiters"]) >= self.max_waiters:
+                return None
+            # Once the call is under way, only its surplus items are left for late arrivals
+            if flight["spare"] is not None:
+                if flight["spare"] <= 0:
+                    return None
+                flight["spare"] -= 1
+            future = Future()
+            flight["waiters"].append(future)
+            self.joined += 1
+            return future
+
+    def lead(self, key, generate):
+        """Open a flight for key, call generate(extra_count) once, hand joiners a distinct matching scenario each
+        and return the remaining scenarios to the caller
+
+        The joining window is only waited out while other live flights are open; with no contention the call starts
+        at once. A call that absorbed joiners asks for one surplus item, which a request arriving mid-call can take.
+        """
+        flight = {"waiters": [], "spare": None}
+        with self._lock:
+            contended = bool(self._flights)
+            self._flights[key] = flight
+            self.flights += 1
+        if contended:
+            time.sleep(self.window)
+        with self._lock:
+            joined = len(flight["waiters"])
+            flight["spare"] = 1 if joined else 0
+            extra = joined + flight["spare"]
+
+        try:
+            scenarios = generate(extra)
+        except Exception:
+            scenarios = []
+        with self._lock:
+            # Closing the flight under the lock means no joiner is added after this point
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            waiters = list(flight["waiters"])
+
+        # Serve joiners from the end so the caller keeps the item it asked for first
+        _, category, is_trivia = key
+        remaining = list(scenarios)
+        handed_out = set()
+        for waiter in waiters:
+            scenario = None
+            for i in range(len(remaining) - 1, -1, -1):
+                candidate = remaining[i]
+                content = scenario_content_hash(candidate)
+                if (
+                    candidate.get('category') == category
+                    and candidate.get('is_trivia') == is_trivia
+                    and content not in handed_out
+                ):
+                    scenario = remaining.pop(i)
+                    handed_out.add(content)
+                    break
+            if scenario is not None:
+                with self._lock:
+                    self.delivered += 1
+            waiter.set_result(scenario)
+        return remaining
+
+    def stats(self):
+        with self._lock:
+            return {
+                "flights": self.flights,
+                "joined": self.joined,
+                "delivered": self.delivered,
+            }
+
+
+@st.cache_resource
+def get_request_coalescer():
+    """Shared single-flight layer for every session in this process"""
+    return RequestCoalescer(Config.COALESCE_WINDOW_SECONDS, Config.COALESCE_MAX_WAITERS)
+
+
+class GameManager:
+    def __init__(self):
+        self.initialize_session_state()
+        
+    def initialize_session_state(self):
+        """Initialize all session state variables"""
+        if 'game_active' not in st.session_state:
+            st.session_state.game_active = False
+        if 'current_round' not in st.session_state:
+            st.session_state.current_round = 0
+        if 'total_score' not in st.session_state:
+            st.session_state.total_score = 0
+        if 'player_name' not in st.session_state:
+            st.session_state.player_name = ""
+        if 'game_history' not in st.session_state:
+            st.session_state.game_history = []
+        if 'current_scenario' not in st.session_state:
+            st.session_state.current_scenario = None
+        if 'showing_answer' not in st.session_state:
+            st.session_state.showing_answer = False
+        if 'player_role' not in st.session_state:
+            st.session_state.player_role = "Any"  # Default to "Any" if no role selected
+        if 'game_id' not in st.session_state:
+            st.session_state.game_id = uuid.uuid4().hex
+        if 'player_base' not in st.session_state:
+            st.session_state.player_base = ""
+        if 'show_about' not in st.session_state:
+            st.session_state.show_about = False
+        if 'topic_categories' not in st.session_state:
+            st.session_state.topic_categories = {category: [] for category in SCENARIO_CATEGORIES}
+        if 'prefetch' not in st.session_state:
+            st.session_state.prefetch = None
+        if 'scenario_queue' not in st.session_state:
+            st.session_state.scenario_queue = []
+        if 'pending_batch' not in st.session_state:
+            st.session_state.pending_batch = None
+        if 'seen_scenarios' not in st.session_state:
+            st.session_state.seen_scenarios = set()
+        if 'game_usage' not in st.session_state:
+            st.session_state.game_usage = self.new_game_usage()
+
+    @staticmethod
+    def new_game_usage():
+        """Per-game Gemini call and token counters, updated by generation threads working for the session"""
+        return {"calls": 0, "prompt_tokens": 0, "response_tokens": 0}
+
+    def generate_scenario(self):
+        """Generate a new unique scenario or airline trivia question using Gemini"""
+        # Live calls run on worker threads so the round can stop waiting at the latency budget;
+        # a call that overruns keeps going and its result still lands in the shared caches
+        deadline = self.round_deadline()
+
+        # Use the scenario prefetched while the previous round was on screen
+        prefetched = self.take_prefetched(deadline)
+        if prefetched is not None:
+            scenario, selected_category = prefetched
+            return self.prepare_scenario(scenario, selected_category)
+
+        # Serve scenarios already generated for this game
+        self.collect_pending_batch()
+        if st.session_state.scenario_queue:
+            scenario = st.session_state.scenario_queue.pop(0)
+            return self.prepare_scenario(scenario, scenario['category'])
+
+        # Get selected role from session state
+        selected_role = st.session_state.player_role
+        selected_category = self.select_category()
+        is_trivia = random.choice([True, False])
+
+        scenario = self.find_ready_scenario(
+            selected_role, selected_category, is_trivia, st.session_state.player_name, st.session_state.seen_scenarios
+        )
+        if scenario is not None:
+            return self.prepare_scenario(scenario, selected_category)
+
+        # Without Gemini top-up, or while Gemini is failing, go straight to the fallback scenarios
+        if not Config.GEMINI_TOP_UP or get_circuit_breaker().is_open():
+            return self.prepare_scenario(self.generate_fallback_scenario(selected_category, is_trivia), selected_category)
+
+        executor = get_foreground_executor()
+        usage = st.session_state.game_usage
+
+        # Share an identical request another session already has in flight
+        if Config.COALESCE_REQUESTS:
+            joined = get_request_coalescer().join((selected_role, selected_category, is_trivia))
+            if joined is not None:
+                scenario = self.wait_within_budget(joined, deadline)
+                if scenario is not None:
+                    get_generation_metrics().increment("coalesced_rounds")
+                    return self.prepare_scenario(scenario, selected_category)
+
+        # On a miss, batch the later rounds in the background; a batch call cannot finish within the round budget,
+        # so this round is streamed or generated on its own
+        self.start_pending_batch(selected_role)
+
+        scenario = None
+        if Config.STREAM_SCENARIOS and self.within_budget(deadline):
+            scenario = self.stream_scenario(selected_role, selected_category, is_trivia, deadline)
+        if scenario is None and self.within_budget(deadline):
+            scenarios = self.wait_within_budget(
+                submit_generation(
+                    executor,
+                    self.request_live, (selected_role, selected_category, is_trivia),
+                    [(selected_category, is_trivia)], usage
+                ),
+                deadline
+            )
+            scenario = scenarios[0] if scenarios else None
+
+        if scenario is None:
+            # Over budget or out of retries: serve anything that became ready meanwhile, else a fallback
+            scenario = self.find_ready_scenario(
+                selected_role, selected_category, is_trivia, st.session_state.player_name, st.session_state.seen_scenarios
+            )
+        if scenario is None:
+            get_generation_metrics().increment("round_fallbacks")
+            scenario = self.generate_fallback_scenario(selected_category, is_trivia)
+        return self.prepare_scenario(scenario, selected_category)
+
+    def start_pending_batch(self, selected_role):
+        """Generate the rest of the game in one background batch call that later rounds are served from"""
+        remaining_rounds = Config.ROUNDS_PER_GAME - st.session_state.current_round
+        if Config.SCENARIO_BATCH_SIZE <= 1 or remaining_rounds < 1 or st.session_state.pending_batch is not None:
+            return
+        assignments = self.plan_assignments(min(Config.SCENARIO_BATCH_SIZE, remaining_rounds))
+        st.session_state.pending_batch = submit_generation(
+            get_generation_executor(),
+            self.request_scenario_batch,
+            selected_role,
+            assignments,
+            st.session_state.game_usage
+        )
+
+    def collect_pending_batch(self):
+        """Move a finished background batch into the session's scenario queue"""
+        future = st.session_state.pending_batch
+        if future is None or not future.done():
+            return
+        st.session_state.pending_batch = None
+        if not future.cancelled() and future.exception() is None:
+            st.session_state.scenario_queue.extend(future.result())
+
+    @staticmethod
+    def round_deadline():
+        """Monotonic time by which a round must be served, or None when the budget is disabled"""
+        if Config.ROUND_LATENCY_BUDGET <= 0:
+            return None
+        return time.monotonic() + Config.ROUND_LATENCY_BUDGET
+
+    @staticmethod
+    def within_budget(deadline):
+        """True while the round may still start a model call"""
+        return deadline is None or time.monotonic() < deadline
+
+    @staticmethod
+    def wait_within_budget(future, deadline):
+        """Wait for a generation future until the deadline, returning None on timeout or failure"""
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            get_generation_metrics().increment("round_budget_exceeded")
+            return None
+        except Exception:
+            return None
+
+    def plan_assignments(self, count):
+        """Pick (category, is_trivia) pairs for upcoming rounds, spread over the least used categories"""
+        used_counts = {cat: len(topics) for cat, topics in st.session_state.topic_categories.items()}
+        # Cycle through the categories when count exceeds the category list
+        categories = sorted(used_counts, key=lambda cat: (used_counts[cat], random.random()))
+        return [
+            (categories[i % len(categories)], random.choice([True, False]))
+            for i in range(count)
+        ]
+
+    def pregenerate_game(self):
+        """Generate every round of the game up front in one parallel fan-out"""
+        selected_role = st.session_state.player_role
+        assignments = self.plan_assignments(Config.ROUNDS_PER_GAME)
+        executor = get_foreground_executor()
+        seen = frozenset(st.session_state.seen_scenarios)
+        futures = [
+            submit_generation(
+                executor,
+                self.fetch_scenario, selected_role, category, is_trivia, st.session_state.player_name, seen,
+                st.session_state.game_usage, True
+            )
+            for category, is_trivia in assignments
+        ]
+
+        progress = st.progress(0.0, text="Preparing your flight... ✈️")
+        for completed, _ in enumerate(as_completed(futures), 1):
+            progress.progress(completed / len(futures), text=f"Preparing your flight... {completed}/{len(futures)} scenarios ready ✈️")
+        progress.empty()
+
+        # Keep the planned order so categories stay spread across rounds
+        st.session_state.scenario_queue = [future.result() for future in futures]
+
+    @staticmethod
+    def find_ready_scenario(selected_role, selected_category, is_trivia, player_name, seen=()):
+        """Return an already generated scenario from the pool, the shared cache, the on-disk store or the bank, or None"""
+        # Popping registers the key for refill, so the pool is only used when Gemini top-up is on
+        if Config.SCENARIO_POOL_ENABLED and Config.GEMINI_TOP_UP:
+            scenario = get_scenario_pool().pop(selected_role, selected_category)
+            if scenario is not None:
                 return scenario
-                
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    # If all attempts fail, create a basic scenario from templates
-                    return self.generate_fallback_scenario(selected_category, is_trivia)
+
+        if Config.SCENARIO_CACHE_ENABLED:
+            scenario = get_scenario_cache().get(selected_role, selected_category, is_trivia, seen)
+            if scenario is not None:
+                return scenario
+
+        if Config.SCENARIO_STORE_ENABLED:
+            store = get_scenario_store()
+            # Prefer the requested question type, but any type beats calling Gemini
+            scenario = store.fetch(selected_role, selected_category, player_name, is_trivia, seen)
+            if scenario is None:
+                scenario = store.fetch(selected_role, selected_category, player_name, seen=seen)
+            get_generation_metrics().increment("store_hits" if scenario is not None else "store_misses")
+            if scenario is not None:
+                return scenario
+
+        if Config.SCENARIO_BANK_ENABLED:
+            scenario = get_scenario_bank().pick(selected_role, selected_category, is_trivia, seen)
+            if scenario is not None:
+                return scenario
+        return None
+
+    @staticmethod
+    def fetch_scenario(selected_role, selected_category, is_trivia, player_name, seen=(), usage=None, foreground=False):
+        """Serve an already generated scenario when one is ready, otherwise call Gemini"""
+        scenario = GameManager.find_ready_scenario(selected_role, selected_category, is_trivia, player_name, seen)
+        if scenario is not None:
+            return scenario
+        if not Config.GEMINI_TOP_UP:
+            return GameManager.generate_fallback_scenario(selected_category, is_trivia)
+        return GameManager.request_scenario(selected_role, selected_category, is_trivia, usage=usage, foreground=foreground)
+
+    def start_prefetch(self):
+        """Start generating the next round's scenario in the background (at most one per session)"""
+        if not Config.PREFETCH_ENABLED or st.session_state.prefetch is not None:
+            return
+        # Later rounds already have a batch on the way
+        self.collect_pending_batch()
+        if st.session_state.scenario_queue or st.session_state.pending_batch is not None:
+            return
+        if st.session_state.current_round >= Config.ROUNDS_PER_GAME:
+            return
+
+        selected_role = st.session_state.player_role
+        selected_category = self.select_category()
+        is_trivia = random.choice([True, False])
+        future = submit_generation(
+            get_generation_executor(),
+            self.fetch_scenario,
+            selected_role,
+            selected_category,
+            is_trivia,
+            st.session_state.player_name,
+            frozenset(st.session_state.seen_scenarios),
+            st.session_state.game_usage
+        )
+        st.session_state.prefetch = {
+            "future": future,
+            "role": selected_role,
+            "category": selected_category
+        }
+
+    def take_prefetched(self, deadline=None):
+        """Return (scenario, category) from the session's prefetch, waiting if it is still in flight"""
+        prefetch = st.session_state.prefetch
+        if prefetch is None:
+            return None
+        scenario = self.wait_within_budget(prefetch["future"], deadline)
+        if scenario is None and not prefetch["future"].done():
+            # Keep a prefetch that is still running attached, so the session never has two in flight;
+            # a later round picks up its result
+            return None
+        st.session_state.prefetch = None
+        if scenario is None or scenario_content_hash(scenario) in st.session_state.seen_scenarios:
+            return None
+        return scenario, prefetch["category"]
+
+    def cancel_prefetch(self):
+        """Drop the session's prefetch and pending batch when the game is abandoned or restarted"""
+        # A batch that is still running keeps going; its scenarios land in the shared caches
+        st.session_state.pending_batch = None
+        prefetch = st.session_state.prefetch
+        if prefetch is None:
+            return
+        st.session_state.prefetch = None
+        self.release_prefetch(prefetch)
+
+    @staticmethod
+    def release_prefetch(prefetch):
+        """Cancel a prefetch nobody will wait for, or hand its result to the pool once it finishes"""
+        if not prefetch["future"].cancel() and Config.SCENARIO_POOL_ENABLED and Config.GEMINI_TOP_UP:
+            # Already running, so hand the result to the pool rather than waste the call
+            pool = get_scenario_pool()
+            role, category = prefetch["role"], prefetch["category"]
+
+            def offer_to_pool(future):
+                if not future.cancelled() and future.exception() is None:
+                    scenario = future.result()
+                    if not scenario.get('is_fallback'):
+                        pool.offer(role, category, scenario)
+
+            prefetch["future"].add_done_callback(offer_to_pool)
+
+    def select_category(self):
+        """Pick one of the least used categories for this session"""
+        used_counts = {cat: len(topics) for cat, topics in st.session_state.topic_categories.items()}
+        min_count = min(used_counts.values())
+        available_categories = [cat for cat, count in used_counts.items() if count == min_count]
+        return random.choice(available_categories)
+
+    def prepare_scenario(self, scenario, selected_category):
+        """Validate the scenario, record it against its category and shuffle its options for display"""
+        validated = self.validate_scenario(scenario)
+        if validated is None:
+            validated = self.generate_fallback_scenario(selected_category, scenario.get('is_trivia', False))
+        scenario = validated
+
+        category = scenario.get('category', selected_category)
+        if category not in st.session_state.topic_categories:
+            category = selected_category
+        st.session_state.topic_categories[category].append(scenario['scenario'])
+        st.session_state.seen_scenarios.add(scenario_content_hash(scenario))
+        if Config.SCENARIO_STORE_ENABLED:
+            get_scenario_store().mark_served(st.session_state.player_name, scenario)
+
+        # Randomly shuffle options
+        options = list(scenario['options'])
+        random.shuffle(options)
+        scenario['options'] = options
+        return scenario
+
+    @staticmethod
+    def build_role_context(selected_role):
+        """Role-specific prompt context, empty when no specific role was selected"""
+        if selected_role == "Any Role":
+            return ""
+        return ROLE_CONTEXT_TEMPLATE.substitute(role=selected_role)
+
+    @staticmethod
+    def build_prompt(selected_role, selected_category, is_trivia):
+        """Build the generation prompt for a role, category and question type"""
+        request = (
+            "an interesting aviation trivia question" if is_trivia else "a unique crew scenario"
+        )
+        # Add role-specific context to the prompt if a specific role was selected
+        suffix = SINGLE_PROMPT_TEMPLATE.substitute(
+            request=request,
+            category=selected_category,
+            role_context=GameManager.build_role_context(selected_role)
+        )
+        GameManager.check_prompt_budget(suffix)
+        return SCENARIO_PROMPT_PREFIX + suffix
+
+    @staticmethod
+    def build_batch_prompt(selected_role, assignments):
+        """Build a prompt asking for one scenario per (category, is_trivia) assignment in a single JSON array"""
+        items = "\n".join(
+            f"            {i}. category: {category}, type: {'trivia' if is_trivia else 'scenario'}"
+            for i, (category, is_trivia) in enumerate(assignments, 1)
+        )
+        suffix = BATCH_PROMPT_TEMPLATE.substitute(
+            count=len(assignments),
+            items=items,
+            role_context=GameManager.build_role_context(selected_role)
+        )
+        GameManager.check_prompt_budget(suffix)
+        return SCENARIO_PROMPT_PREFIX + suffix
+
+    @staticmethod
+    def check_prompt_budget(suffix):
+        """Estimate prompt tokens and refuse prompts that would not leave room for the response"""
+        estimated = get_prompt_token_counter().estimate(SCENARIO_PROMPT_PREFIX, suffix)
+        get_generation_metrics().set_gauge("last_prompt_tokens_estimated", estimated)
+        if estimated > Config.MAX_CONTEXT_LENGTH - Config.MAX_OUTPUT_TOKENS:
+            get_generation_metrics().increment("prompt_over_budget")
+            raise PromptBudgetError(f"Prompt needs about {estimated} tokens, over the context budget")
+        return estimated
+
+    @staticmethod
+    def record_usage(response, usage=None):
+        """Record prompt/response token counts reported by Gemini, process-wide and for the calling game"""
+        usage_metadata = getattr(response, 'usage_metadata', None)
+        if usage_metadata is None:
+            return
+        prompt_tokens = usage_metadata.prompt_token_count
+        response_tokens = usage_metadata.candidates_token_count
+        metrics = get_generation_metrics()
+        metrics.increment("model_calls_with_usage")
+        metrics.increment("prompt_tokens", prompt_tokens)
+        metrics.increment("response_tokens", response_tokens)
+        metrics.increment("cached_prompt_tokens", getattr(usage_metadata, 'cached_content_token_count', 0) or 0)
+        metrics.set_gauge("last_call_tokens", {"prompt": prompt_tokens, "response": response_tokens})
+        if usage is not None:
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["response_tokens"] += response_tokens
+
+    @staticmethod
+    def parse_model_json(text):
+        """Strip markdown fences from a model response and parse the JSON inside"""
+        scenario_str = text.strip()
+        scenario_str = scenario_str.replace("```json", "").replace("```", "").strip()
+        return json.loads(scenario_str)
+
+    @staticmethod
+    def repair_model_json(text):
+        """Salvage fenced, wrapped, smart-quoted, trailing-comma or truncated JSON, returning None if nothing parses"""
+        text = re.sub(r'```(?:json)?', '', text)
+        # Smart quotes are valid inside strings, so only swap them if the text does not parse as is
+        for candidate in (text, text.translate(SMART_QUOTES)):
+            starts = [index for index in (candidate.find('{'), candidate.find('[')) if index != -1]
+            if not starts:
                 continue
-                
-        return self.generate_fallback_scenario(selected_category, is_trivia)
+            try:
+                return json.loads(close_truncated_json(candidate[min(starts):]))
+            except ValueError:
+                continue
+        return None
 
-    def generate_fallback_scenario(self, category, is_trivia):
+    @staticmethod
+    def fill_optional_fields(scenario, selected_category):
+        """Default the fields a salvaged response may be missing; scenario, options and explanation stay required"""
+        if not isinstance(scenario, dict):
+            return scenario
+        if scenario.get('category') not in SCENARIO_CATEGORIES:
+            scenario['category'] = selected_category
+        scenario.setdefault('context', scenario['category'].replace('_', ' ').title())
+        scenario.setdefault('difficulty', 'Medium')
+        scenario.setdefault('points', 10)
+        scenario.setdefault('fun_facts', [])
+        return scenario
+
+    @staticmethod
+    def load_model_json(text, structured=False):
+        """Parse a model response, falling back to a repair pass before giving up"""
+        metrics = get_generation_metrics()
+        mode = "structured" if structured else "freeform"
+        metrics.increment(f"parse_attempts_{mode}")
+        try:
+            return GameManager.parse_model_json(text)
+        except ValueError:
+            metrics.increment(f"parse_failures_{mode}")
+            repaired = GameManager.repair_model_json(text)
+            if repaired is None:
+                raise
+            metrics.increment("parse_repaired")
+            return repaired
+
+    @staticmethod
+    def call_model(prompt, schema=None, chunks=None, foreground=False):
+        """Call Gemini on the shared engine through the circuit breaker, streaming into chunks when given"""
+        breaker = get_circuit_breaker()
+        if not breaker.allow():
+            raise CircuitOpenError("Gemini circuit is open")
+
+        generation_config = None
+        if schema is not None and Config.STRUCTURED_OUTPUT:
+            generation_config = {"response_mime_type": "application/json", "response_schema": schema}
+
+        # Send only the request tail when the static prefix is held in Gemini's context cache
+        # Charge the rate limiter the prompt estimate; the engine settles it against reported usage
+        if prompt.startswith(SCENARIO_PROMPT_PREFIX):
+            tokens = get_prompt_token_counter().estimate(SCENARIO_PROMPT_PREFIX, prompt[len(SCENARIO_PROMPT_PREFIX):])
+        else:
+            tokens = len(prompt) // CHARS_PER_TOKEN + 1
+
+        target_model, contents = model, prompt
+        if Config.CONTEXT_CACHE_ENABLED:
+            target_model, contents = get_prompt_prefix_cache().route(prompt)
+        try:
+            response = get_generation_engine().generate(
+                target_model,
+                contents,
+                chunks=chunks,
+                timeout=Config.MODEL_CALL_TIMEOUT,
+                tokens=tokens,
+                foreground=foreground,
+                generation_config=generation_config,
+                request_options={"timeout": Config.MODEL_CALL_TIMEOUT}
+            )
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response
+
+    @staticmethod
+    def generate_json(prompt, accept, max_attempts=None, schema=None, usage=None, foreground=False):
+        """Call Gemini with classified, backed-off retries until accept(parsed) returns a result"""
+        metrics = get_generation_metrics()
+        max_attempts = max_attempts or Config.GENERATION_MAX_ATTEMPTS
+        deadline = time.monotonic() + Config.GENERATION_RETRY_DEADLINE
+        attempt_prompt = prompt
+        structured = schema is not None and Config.STRUCTURED_OUTPUT
+
+        for attempt in range(max_attempts):
+            try:
+                response = GameManager.call_model(attempt_prompt, schema=schema, foreground=foreground)
+                GameManager.record_usage(response, usage)
+                parsed = GameManager.load_model_json(response.text, structured=structured)
+                result = accept(parsed)
+                cause = "invalid" if result is None else None
+            except Exception as e:
+                result = None
+                cause = classify_generation_error(e)
+
+            if result is not None:
+                return result
+            metrics.increment(f"retry_cause_{cause}")
+            if cause == "circuit_open":
+                break
+
+            # Ask for bare JSON rather than resending a prompt that already produced unparseable output
+            if cause == "parse":
+                attempt_prompt = prompt + JSON_ONLY_REMINDER
+
+            delay = retry_delay(cause, attempt)
+            if attempt == max_attempts - 1 or time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        metrics.increment("requests_exhausted")
+        return None
+
+    @staticmethod
+    def validate_scenario(scenario):
+        """Return the normalized scenario dict, or None if it fails validation"""
+        try:
+            return Scenario.from_dict(scenario).to_dict()
+        except ScenarioValidationError:
+            get_generation_metrics().increment("validation_rejected")
+            return None
+
+    @staticmethod
+    def request_scenario_batch(selected_role, assignments, usage=None, foreground=False):
+        """Call Gemini once for several scenarios and return the elements that validate"""
+        try:
+            prompt = GameManager.build_batch_prompt(selected_role, assignments)
+        except PromptBudgetError:
+            return []
+        metrics = get_generation_metrics()
+
+        def accept(items):
+            if isinstance(items, dict):
+                items = [items]
+            if not isinstance(items, list):
+                return None
+
+            # Validate each element independently so one bad item does not sink the batch
+            scenarios = []
+            for item, (category, is_trivia) in zip(items, assignments):
+                item = GameManager.fill_optional_fields(item, category)
+                if isinstance(item, dict):
+                    item_type = str(item.pop('type', '')).lower()
+                    item['is_trivia'] = item_type == 'trivia' if item_type in ('trivia', 'scenario') else is_trivia
+                item = GameManager.validate_scenario(item)
+                if item is not None:
+                    scenarios.append(item)
+
+            metrics.increment("batch_calls")
+            metrics.increment("batch_items_requested", len(assignments))
+            metrics.increment("batch_items_valid", len(scenarios))
+            if not scenarios:
+                return None
+            GameManager.remember_scenarios(selected_role, scenarios)
+            return scenarios
+
+        return GameManager.generate_json(
+            prompt, accept, max_attempts=3, schema=BATCH_RESPONSE_SCHEMA, usage=usage, foreground=foreground
+        ) or []
+
+    @staticmethod
+    def remember_scenarios(selected_role, scenarios):
+        """Share freshly generated scenarios with other sessions and persist them for restarts"""
+        for scenario in scenarios:
+            # Keep copies so later option shuffling does not touch the shared payload
+            if Config.SCENARIO_CACHE_ENABLED:
+                get_scenario_cache().put(selected_role, scenario['category'], json.loads(json.dumps(scenario)))
+            if Config.SCENARIO_STORE_ENABLED:
+                get_scenario_store().save(selected_role, dict(scenario))
+
+    @staticmethod
+    def finalize_scenario(scenario, selected_role, selected_category, is_trivia):
+        """Tag a parsed model response and share it, or return None if it is unusable"""
+        scenario = GameManager.fill_optional_fields(scenario, selected_category)
+        if isinstance(scenario, dict):
+            # Add type flag to scenario
+            scenario['is_trivia'] = is_trivia
+        scenario = GameManager.validate_scenario(scenario)
+        if scenario is None:
+            return None
+        GameManager.remember_scenarios(selected_role, [scenario])
+        return scenario
+
+    @staticmethod
+    def extract_partial_scenario(text):
+        """Pull the fields that are already complete out of a partially streamed JSON response"""
+        partial = {}
+        for field in ('scenario', 'context', 'difficulty'):
+            match = re.search(rf'"{field}"\s*:\s*"((?:[^"\\]|\\.)*)"', text)
+            if match:
+                # strict=False accepts raw newlines the model may leave inside the text
+                try:
+                    partial[field] = json.loads(f'"{match.group(1)}"', strict=False)
+                except ValueError:
+                    pass
+
+        options_start = re.search(r'"options"\s*:\s*(?=\[)', text)
+        if options_start:
+            # Close the array where it really ends (or where the stream stops) rather than at a "]" inside a text
+            try:
+                options = json.loads(close_truncated_json(text[options_start.end():]), strict=False)
+            except ValueError:
+                options = []
+            partial['options'] = [
+                option['text'] for option in options
+                if isinstance(option, dict) and isinstance(option.get('text'), str)
+            ]
+        return partial
+
+    def render_partial_scenario(self, placeholder, partial, is_trivia):
+        """Show the streamed scenario text, and any options received so far, while generation finishes"""
+        icon = "🎯" if is_trivia else "✈️"
+        title = "Aviation Trivia" if is_trivia else f"Scenario {st.session_state.current_round}"
+        options = "".join(f"<li>{option}</li>" for option in partial.get('options', []))
+        placeholder.markdown(
+            f"""
+            <div class="scenario-box">
+                <span class="chip chip-context">{partial.get('context', '...')}</span>
+                <span class="chip chip-difficulty">{partial.get('difficulty', '...')}</span>
+                <h3>{icon} {title}</h3>
+                <p>{partial['scenario']}</p>
+                <ul>{options}</ul>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+
+    def stream_scenario(self, selected_role, selected_category, is_trivia, deadline=None):
+        """Stream one scenario on a worker thread, rendering its text here as soon as it arrives
+
+        The round budget applies until the first content is shown; after that the stream is allowed to finish
+        (bounded by MODEL_CALL_TIMEOUT) rather than replacing visible text with a fallback.
+        """
+        metrics = get_generation_metrics()
+        chunks = []
+        future = submit_generation(
+            get_foreground_executor(),
+            self.consume_stream, selected_role, selected_category, is_trivia, chunks, st.session_state.game_usage
+        )
+        placeholder = st.empty()
+        started = time.monotonic()
+        rendered_chunks = 0
+        first_content = False
+        try:
+            while not future.done():
+                if not first_content and not self.within_budget(deadline):
+                    metrics.increment("round_budget_exceeded")
+                    return None
+                if len(chunks) != rendered_chunks:
+                    rendered_chunks = len(chunks)
+                    partial = self.extract_partial_scenario("".join(chunks))
+                    if 'scenario' in partial:
+                        if not first_content:
+                            metrics.observe("stream_first_content", time.monotonic() - started)
+                            first_content = True
+                        self.render_partial_scenario(placeholder, partial, is_trivia)
+                wait([future], timeout=0.05)
+            return future.result()
+        except Exception:
+            return None
+        finally:
+            placeholder.empty()
+
+    @staticmethod
+    def consume_stream(selected_role, selected_category, is_trivia, chunks, usage=None):
+        """Run a streamed Gemini call, appending text chunks for the UI, and return the finished scenario or None"""
+        metrics = get_generation_metrics()
+        started = time.monotonic()
+        try:
+            prompt = GameManager.build_prompt(selected_role, selected_category, is_trivia)
+            # No response schema here: Gemini emits schema properties alphabetically, which would put "scenario"
+            # last, while the prompt's JSON shape streams it first so it can be shown early.
+            # The engine consumes the whole stream, so call_model counts any failure once
+            response = GameManager.call_model(prompt, chunks=chunks, foreground=True)
+        except Exception:
+            metrics.increment("stream_failures")
+            return None
+        metrics.observe("stream_complete", time.monotonic() - started)
+        GameManager.record_usage(response, usage)
+
+        try:
+            scenario = GameManager.load_model_json("".join(chunks))
+        except ValueError:
+            metrics.increment("stream_failures")
+            return None
+        return GameManager.finalize_scenario(scenario, selected_role, selected_category, is_trivia)
+
+    @staticmethod
+    def request_live(key, assignments, usage=None):
+        """Generate a round a player is waiting on as a flight that identical requests from other sessions can join"""
+        selected_role, selected_category, is_trivia = key
+
+        def generate(extra):
+            planned = list(assignments) + [(selected_category, is_trivia)] * extra
+            if len(planned) == 1:
+                scenario = GameManager.request_scenario(
+                    selected_role, selected_category, is_trivia, fallback=False, usage=usage, foreground=True
+                )
+                return [scenario] if scenario is not None else []
+            return GameManager.request_scenario_batch(selected_role, planned, usage=usage, foreground=True)
+
+        if not Config.COALESCE_REQUESTS:
+            return generate(0)
+        return get_request_coalescer().lead(key, generate)
+
+    @staticmethod
+    def request_scenario(selected_role, selected_category, is_trivia, fallback=True, usage=None, foreground=False):
+        """Call Gemini for one scenario; safe to use outside the Streamlit script thread"""
+        scenario = None
+        try:
+            prompt = GameManager.build_prompt(selected_role, selected_category, is_trivia)
+        except PromptBudgetError:
+            prompt = None
+        if prompt is not None:
+            scenario = GameManager.generate_json(
+                prompt,
+                lambda parsed: GameManager.finalize_scenario(parsed, selected_role, selected_category, is_trivia),
+                schema=SCENARIO_RESPONSE_SCHEMA,
+                usage=usage,
+                foreground=foreground
+            )
+        if scenario is not None:
+            return scenario
+
+        if fallback:
+            # If all attempts fail, create a basic scenario from templates
+            return GameManager.generate_fallback_scenario(selected_category, is_trivia)
+        return None
+
+    @staticmethod
+    def generate_fallback_scenario(category, is_trivia):
         """Generate a basic scenario based on templates if API fails"""
+        # Prefer a hand-written fallback scenario for this category when one exists
+        handwritten = [scenario for scenario in FALLBACK_SCENARIOS if scenario.get('category') == category]
+        if handwritten:
+            scenario = json.loads(json.dumps(random.choice(handwritten)))
+            scenario['is_trivia'] = is_trivia
+            scenario['is_fallback'] = True
+            return scenario
+
         templates = {
             'customer_service': {
                 'scenario': f"A passenger requests a unique accommodation during {random.choice(['boarding', 'the flight', 'deplaning'])}",
@@ -330,7 +2896,8 @@ class GameManager:
                 "The average flight attendant walks about 5 miles during each flight",
                 "Southwest's first flight took off from Dallas Love Field in 1971"
             ],
-            'is_trivia': is_trivia
+            'is_trivia': is_trivia,
+            'is_fallback': True
         }
         
         return scenario
@@ -409,6 +2976,7 @@ class GameManager:
         """Display end-game summary with enhanced visuals"""
         st.markdown("## Game Summary")
         st.markdown(f"**Final Score: {st.session_state.total_score} points**")
+        self.display_standings()
         
         for idx, round_data in enumerate(st.session_state.game_history, 1):
             with st.expander(f"Round {idx} - {round_data['context']}"):
@@ -429,13 +2997,65 @@ class GameManager:
 
     def update_leaderboard(self):
         """Update the leaderboard with current game results"""
-        st.session_state.leaderboard.append({
-            "name": st.session_state.player_name,
-            "score": st.session_state.total_score,
-            "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-        })
-        st.session_state.leaderboard.sort(key=lambda x: x["score"], reverse=True)
-        st.session_state.leaderboard = st.session_state.leaderboard[:10]    
+        get_leaderboard().record(
+            st.session_state.player_name,
+            st.session_state.player_role,
+            st.session_state.total_score,
+            groups=[st.session_state.player_base]
+        )
+
+    def display_standings(self):
+        """Show how this game compares this week overall, among the player's role and at their base"""
+        leaderboard = get_leaderboard()
+        role = st.session_state.player_role
+        boards = [("players", {})]
+        if role not in ("Any", "Any Role"):
+            boards.append((f"{role.lower()}s", {"role": role}))
+        if st.session_state.player_base:
+            boards.append((f"crew at {st.session_state.player_base}", {"group": st.session_state.player_base}))
+        for label, partition in boards:
+            percentile = leaderboard.percentile(
+                st.session_state.total_score, window="week", player=st.session_state.player_name, **partition
+            )
+            standing = leaderboard.standing(st.session_state.player_name, window="week", **partition)
+            if percentile is None or standing is None or standing["players"] < 2:
+                continue
+            st.markdown(
+                f"You beat **{percentile}%** of {label} this week "
+                f"(best rank #{standing['rank']} of {standing['players']})"
+            )
+
+    def display_generation_metrics(self):
+        """Display scenario generation metrics for operators"""
+        metrics = {}
+        if Config.SCENARIO_POOL_ENABLED and Config.GEMINI_TOP_UP:
+            metrics["scenario_pool"] = get_scenario_pool().stats()
+        if Config.SCENARIO_CACHE_ENABLED:
+            metrics["scenario_cache"] = get_scenario_cache().stats()
+        if Config.SCENARIO_STORE_ENABLED:
+            metrics["scenario_store"] = get_scenario_store().stats()
+        if Config.SCENARIO_BANK_ENABLED:
+            metrics["scenario_bank"] = get_scenario_bank().stats()
+        metrics["generation_engine"] = get_generation_engine().stats()
+        if Config.COALESCE_REQUESTS:
+            metrics["request_coalescer"] = get_request_coalescer().stats()
+        metrics["circuit_breaker"] = get_circuit_breaker().stats()
+        metrics["leaderboard"] = get_leaderboard().stats()
+        if Config.HISTORY_ENABLED:
+            metrics["round_history"] = get_round_history().stats()
+        if Config.CONTEXT_CACHE_ENABLED:
+            metrics["prompt_prefix_cache"] = get_prompt_prefix_cache().stats()
+        generation = get_generation_metrics().snapshot()
+        counters = generation["counters"]
+        generation["parse_failure_rate"] = {
+            mode: round(counters.get(f"parse_failures_{mode}", 0) / counters[f"parse_attempts_{mode}"], 3)
+            for mode in ("structured", "freeform")
+            if counters.get(f"parse_attempts_{mode}")
+        }
+        metrics["generation"] = generation
+        metrics["this_game_usage"] = dict(st.session_state.game_usage)
+        with st.expander("📊 Generation Metrics"):
+            st.json(metrics)
     
     
         
@@ -450,7 +3070,16 @@ def main():
         st.markdown("## Source: [Wikimedia Commons](https://commons.wikimedia.org/wiki/File:Freedom_one.png)")
         st.image("https://upload.wikimedia.org/wikipedia/commons/thumb/1/13/Freedom_one.png/320px-Freedom_one.png", width=200)
         st.markdown("### 🏆 Top Performers")
-        for idx, entry in enumerate(st.session_state.leaderboard[:5], 1):
+        window = st.selectbox(
+            "Period", list(LEADERBOARD_WINDOWS), format_func=LEADERBOARD_WINDOWS.get, key="leaderboard_window"
+        )
+        board = st.selectbox("Board", ["Everyone", "My role", "My base"], key="leaderboard_board")
+        partition = {}
+        if board == "My role":
+            partition = {"role": st.session_state.player_role}
+        elif board == "My base" and st.session_state.player_base:
+            partition = {"group": st.session_state.player_base}
+        for idx, entry in enumerate(get_leaderboard().top(5, window=window, **partition), 1):
             st.write(f"{idx}. {entry['name']}: {entry['score']} pts ({entry['date']})")
             
         st.markdown("---")  # Adds a separator line
@@ -497,6 +3126,9 @@ def main():
             """, unsafe_allow_html=True)
             st.session_state.show_about = not st.session_state.show_about
 
+        st.markdown("---")
+        game.display_generation_metrics()
+
             
     if st.session_state.game_active:
         game.display_game_stats()
@@ -510,20 +3142,14 @@ def main():
         """)
         
         name = st.text_input("Enter your name:", key="name_input")
+        base = st.text_input("Crew base (Optional):", key="base_input", placeholder="e.g. DAL")
         
         # Add this new section for role selection
         cols = st.columns([2, 1])  # Create two columns for layout
         with cols[0]:
             role = st.selectbox(
                 "Choose your role (Optional):",
-                [
-                    "Any Role",
-                    "Flight Attendant",
-                    "Pilot",
-                    "Ground Operations",
-                    "Customer Service Agent",
-                    "Operations Agent"
-                ],
+                PLAYER_ROLES,
                 index=0,  # Default to "Any Role"
                 help="Select your SWA role to get role-specific scenarios!"
             )       
@@ -533,10 +3159,20 @@ def main():
                 if name.strip():
                     st.session_state.player_name = name
                     st.session_state.player_role = role
+                    st.session_state.player_base = base.strip().upper()
                     st.session_state.game_active = True
                     st.session_state.current_round = 1
                     st.session_state.total_score = 0
                     st.session_state.game_history = []
+                    st.session_state.current_scenario = None
+                    st.session_state.scenario_queue = []
+                    st.session_state.game_usage = game.new_game_usage()
+                    st.session_state.game_id = uuid.uuid4().hex
+                    game.cancel_prefetch()
+                    if Config.SCENARIO_POOL_ENABLED and Config.GEMINI_TOP_UP:
+                        get_scenario_pool().watch(role)
+                    if Config.PREGENERATE_GAME:
+                        game.pregenerate_game()
                     st.rerun()
                 else:
                     st.warning("Please enter your name to begin!")
@@ -547,6 +3183,7 @@ def main():
             st.session_state.current_scenario = game.generate_scenario()
         
         choice = game.display_scenario(st.session_state.current_scenario)
+        game.start_prefetch()
         
         if st.button("Submit Answer"):
             points, is_correct, explanation = game.process_answer(
@@ -555,17 +3192,28 @@ def main():
             st.session_state.total_score += points
             
             # Record round history
-            st.session_state.game_history.append({
+            round_record = {
+                "game_id": st.session_state.game_id,
+                "played_at": time.time(),
+                "player": st.session_state.player_name,
+                "role": st.session_state.player_role,
+                "base": st.session_state.player_base,
                 "round": st.session_state.current_round,
+                "category": st.session_state.current_scenario['category'],
+                "is_trivia": st.session_state.current_scenario.get('is_trivia', False),
                 "context": st.session_state.current_scenario['context'],
                 "difficulty": st.session_state.current_scenario['difficulty'],
                 "scenario": st.session_state.current_scenario['scenario'],
                 "player_choice": choice,
                 "correct_answer": next(opt['text'] for opt in st.session_state.current_scenario['options'] if opt['is_correct']),
+                "is_correct": is_correct,
                 "points": points,
                 "possible_points": st.session_state.current_scenario['points'],
                 "explanation": explanation
-            })
+            }
+            st.session_state.game_history.append(round_record)
+            if Config.HISTORY_ENABLED:
+                get_round_history().append(round_record)
             
             # Display immediate feedback
             if is_correct:
@@ -589,6 +3237,7 @@ def main():
         game.display_game_summary()
         
         if st.button("Start New Game"):
+            game.cancel_prefetch()
             st.session_state.game_active = False
             st.rerun()
 
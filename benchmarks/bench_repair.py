@@ -0,0 +1,54 @@
+"""Replay recorded bad Gemini responses through the JSON repair layer and time it.
+
+Run from the project root: python benchmarks/bench_repair.py
+Exits non-zero when a response no longer salvages the recorded number of valid scenarios.
+"""
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import GameManager  # noqa: E402
+
+CORPUS_PATH = os.path.join(ROOT, "benchmarks", "repair_corpus.json")
+REPEATS = 200
+
+
+def count_valid(text):
+    """Number of scenarios the repair layer salvages from one raw response"""
+    parsed = GameManager.repair_model_json(text)
+    if parsed is None:
+        return 0
+    items = parsed if isinstance(parsed, list) else [parsed]
+    return sum(
+        1 for item in items
+        if GameManager.validate_scenario(GameManager.fill_optional_fields(item, "customer_service")) is not None
+    )
+
+
+def main():
+    with open(CORPUS_PATH, encoding="utf-8") as corpus_file:
+        corpus = json.load(corpus_file)
+
+    regressions = 0
+    for case in corpus:
+        valid = count_valid(case["response"])
+        started = time.perf_counter()
+        for _ in range(REPEATS):
+            GameManager.repair_model_json(case["response"])
+        micros = (time.perf_counter() - started) / REPEATS * 1e6
+
+        status = "ok" if valid == case["expect_valid"] else "REGRESSION"
+        regressions += status != "ok"
+        print(f"{status:<10} {case['name']:<36} valid={valid}/{case['expect_valid']} {micros:8.1f} µs")
+
+    salvaged = sum(1 for case in corpus if case["expect_valid"])
+    print(f"\n{salvaged}/{len(corpus)} recorded responses salvageable without a retry, {regressions} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
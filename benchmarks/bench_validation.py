@@ -0,0 +1,42 @@
+"""Time Scenario validation on typical and rejected payloads.
+
+Run from the project root: python benchmarks/bench_validation.py
+"""
+import copy
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import FALLBACK_SCENARIOS, Scenario, ScenarioValidationError  # noqa: E402
+
+REPEATS = 20000
+
+
+def time_case(name, payload):
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        try:
+            Scenario.from_dict(payload)
+        except ScenarioValidationError:
+            pass
+    micros = (time.perf_counter() - started) / REPEATS * 1e6
+    print(f"{name:<28} {micros:6.2f} µs per validation")
+
+
+def main():
+    valid = copy.deepcopy(FALLBACK_SCENARIOS[0])
+    needs_normalizing = dict(valid, difficulty="Easy/Medium/Hard", points=40)
+    two_correct = dict(valid, options=[dict(option, is_correct=True) for option in valid['options']])
+    duplicate_option = dict(valid, options=valid['options'] + [valid['options'][0]])
+
+    time_case("valid", valid)
+    time_case("normalized difficulty/points", needs_normalizing)
+    time_case("rejected: two correct", two_correct)
+    time_case("rejected: duplicate option", duplicate_option)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Bulk-generate a versioned scenario bank that the app serves before calling Gemini.
+
+Run from the project root: python build_scenario_bank.py --per-category 200
+Uses the app's prompts, retries and validation; duplicate scenarios are dropped.
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app import (
+    Config,
+    GameManager,
+    PLAYER_ROLES,
+    SCENARIO_CATEGORIES,
+    ScenarioBank,
+    scenario_content_hash,
+    write_scenario_bank,
+)
+
+
+def load_existing(path):
+    """Scenarios from an existing bank of the current version, or [] when there is none"""
+    bank = ScenarioBank(path)
+    if bank.load_error not in (None, "missing"):
+        print(f"Ignoring {path}: {bank.load_error}")
+    if bank.load_error:
+        return []
+    return list(bank.scenarios())
+
+
+def plan_jobs(roles, categories, per_category, batch_size, have):
+    """Split the missing scenarios per role and category into batch-sized jobs, alternating question types"""
+    jobs = []
+    for role in roles:
+        for category in categories:
+            missing = per_category - have.get((role, category), 0)
+            while missing > 0:
+                count = min(batch_size, missing)
+                jobs.append((role, [(category, i % 2 == 0) for i in range(count)]))
+                missing -= count
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--per-category", type=int, default=200, help="scenarios per role and category")
+    parser.add_argument("--roles", nargs="+", default=PLAYER_ROLES, choices=PLAYER_ROLES, metavar="ROLE")
+    parser.add_argument("--categories", nargs="+", default=SCENARIO_CATEGORIES, choices=SCENARIO_CATEGORIES)
+    parser.add_argument("--batch-size", type=int, default=Config.SCENARIO_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=Config.MAX_IN_FLIGHT_REQUESTS)
+    parser.add_argument("--output", default=Config.SCENARIO_BANK_PATH)
+    parser.add_argument("--fresh", action="store_true", help="rebuild instead of topping up the existing bank")
+    args = parser.parse_args()
+
+    # Bank builds should not fill the app's shared caches or its on-disk store
+    Config.SCENARIO_CACHE_ENABLED = False
+    Config.SCENARIO_STORE_ENABLED = False
+
+    scenarios = [] if args.fresh else load_existing(args.output)
+    hashes = {scenario_content_hash(scenario) for scenario in scenarios}
+    have = {}
+    for scenario in scenarios:
+        key = (scenario.get('role'), scenario.get('category'))
+        have[key] = have.get(key, 0) + 1
+
+    jobs = plan_jobs(args.roles, args.categories, args.per_category, max(1, args.batch_size), have)
+    print(f"{len(scenarios)} scenarios in the existing bank, {len(jobs)} batches to generate")
+
+    started = time.monotonic()
+    duplicates = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(GameManager.request_scenario_batch, role, assignments): role
+            for role, assignments in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            role = futures[future]
+            batch = future.result()
+            if not batch:
+                failed += 1
+            for scenario in batch:
+                content_hash = scenario_content_hash(scenario)
+                if content_hash in hashes:
+                    duplicates += 1
+                    continue
+                hashes.add(content_hash)
+                scenario.pop('is_fallback', None)
+                scenarios.append(dict(scenario, role=role))
+            if done % 20 == 0 or done == len(jobs):
+                print(f"{done}/{len(jobs)} batches, {len(scenarios)} scenarios, {time.monotonic() - started:.0f}s")
+
+    write_scenario_bank(args.output, scenarios, Config.MODEL_NAME)
+    print(f"Wrote {len(scenarios)} scenarios to {args.output} ({duplicates} duplicates dropped, {failed} failed batches)")
+    return 1 if failed == len(jobs) and jobs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""Export recorded rounds and stored scenarios to partitioned Parquet, and report per-category accuracy.
+
+Run from the project root:
+    python export_history.py export --out exports
+    python export_history.py accuracy --out exports
+Exports are incremental: each run appends only rounds recorded since the previous one.
+Rows are streamed from SQLite in fixed-size batches, each written as one Parquet row group, so memory stays flat.
+"""
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from app import Config, RoundHistoryStore
+
+BATCH_ROWS = 50000
+STATE_FILE = "_export_state.json"
+
+
+def rounds_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.int64()),
+        ("game_id", pa.string()),
+        ("played_at", pa.timestamp("ms")),
+        ("player", pa.string()),
+        ("role", pa.string()),
+        ("base", pa.string()),
+        ("round", pa.int16()),
+        ("category", pa.string()),
+        ("is_trivia", pa.bool_()),
+        ("context", pa.string()),
+        ("difficulty", pa.string()),
+        ("scenario", pa.string()),
+        ("player_choice", pa.string()),
+        ("correct_answer", pa.string()),
+        ("is_correct", pa.bool_()),
+        ("points", pa.int16()),
+        ("possible_points", pa.int16()),
+        ("explanation", pa.string()),
+    ])
+
+
+def scenarios_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("content_hash", pa.string()),
+        ("role", pa.string()),
+        ("difficulty", pa.string()),
+        ("is_trivia", pa.bool_()),
+        ("created_at", pa.timestamp("ms")),
+        ("serve_count", pa.int32()),
+        ("scenario", pa.string()),
+        ("correct_answer", pa.string()),
+        ("payload", pa.string()),
+    ])
+
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE), encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {"rounds_last_id": 0}
+
+
+def save_state(out_dir, state):
+    tmp_path = os.path.join(out_dir, STATE_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, os.path.join(out_dir, STATE_FILE))
+
+
+class PartitionWriters:
+    """One open ParquetWriter per hive partition directory; every write_table call adds a row group"""
+
+    def __init__(self, root, column, schema, file_name):
+        self.root = root
+        self.column = column
+        self.schema = schema
+        self.file_name = file_name
+        self._writers = {}
+
+    def write(self, partition, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = self._writers.get(partition)
+        if writer is None:
+            directory = os.path.join(self.root, f"{self.column}={partition}")
+            os.makedirs(directory, exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(directory, self.file_name), self.schema, compression="zstd")
+            self._writers[partition] = writer
+        writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+
+
+def split_by_partition(rows, key):
+    """Group a batch of row dicts into column dicts per partition value"""
+    partitions = {}
+    for row in rows:
+        columns = partitions.setdefault(key(row), {})
+        for name, value in row.items():
+            columns.setdefault(name, []).append(value)
+    return partitions
+
+
+def export_rounds(history_path, out_dir, state, batch_rows=BATCH_ROWS):
+    """Append rounds recorded since the last export, partitioned by month; returns the number of rows written"""
+    if not os.path.exists(history_path):
+        return 0
+    names = ("id",) + RoundHistoryStore.COLUMNS
+    conn = sqlite3.connect(f"file:{history_path}?mode=ro", uri=True)
+    cursor = conn.execute(
+        f"SELECT {', '.join(names)} FROM rounds WHERE id > ? ORDER BY id", (state["rounds_last_id"],)
+    )
+    writers = PartitionWriters(
+        os.path.join(out_dir, "rounds"), "month", rounds_schema(), f"part-{state['rounds_last_id'] + 1:012d}.parquet"
+    )
+    exported = 0
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_rows)
+            if not batch:
+                break
+            rows = []
+            for values in batch:
+                row = dict(zip(names, values))
+                row["played_at"] = datetime.datetime.fromtimestamp(row["played_at"])
+                row["is_trivia"] = bool(row["is_trivia"])
+                row["is_correct"] = bool(row["is_correct"])
+                rows.append(row)
+            for month, columns in split_by_partition(rows, lambda row: row["played_at"].strftime("%Y-%m")).items():
+                writers.write(month, columns)
+            exported += len(batch)
+            state["rounds_last_id"] = batch[-1][0]
+    finally:
+        writers.close()
+        conn.close()
+    return exported
+
+
+def export_scenarios(store_path, out_dir, batch_rows=BATCH_ROWS):
+    """Rewrite the snapshot of stored scenarios, partitioned by category; returns the number of rows written"""
+    if not os.path.exists(store_path):
+        return 0
+    conn = sqlite3.connect(f"file:{store_path}?mode=ro", uri=True)
+    cursor = conn.execute(
+        "SELECT content_hash, role, category, difficulty, is_trivia, created_at, serve_count, payload FROM scenarios"
+    )
+    # Serve counts change between runs, so scenarios are exported as a fresh snapshot rather than appended
+    writers = PartitionWriters(os.path.join(out_dir, "scenarios"), "category", scenarios_schema(), "snapshot.parquet")
+    exported = 0
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_rows)
+            if not batch:
+                break
+            rows = []
+            for content_hash, role, category, difficulty, is_trivia, created_at, serve_count, payload in batch:
+                scenario = json.loads(payload)
+                rows.append({
+                    "content_hash": content_hash,
+                    "role": role,
+                    "category": category,
+                    "difficulty": difficulty,
+                    "is_trivia": bool(is_trivia),
+                    "created_at": datetime.datetime.fromtimestamp(created_at),
+                    "serve_count": serve_count,
+                    "scenario": scenario.get('scenario', ''),
+                    "correct_answer": next(
+                        (option['text'] for option in scenario.get('options', []) if option.get('is_correct')), ''
+                    ),
+                    "payload": payload,
+                })
+            for category, columns in split_by_partition(rows, lambda row: row.pop("category")).items():
+                writers.write(category, columns)
+            exported += len(batch)
+    finally:
+        writers.close()
+        conn.close()
+    return exported
+
+
+def category_accuracy(out_dir, role=None, since=None):
+    """Per-category answer accuracy over the exported rounds, least accurate first, as a pandas DataFrame
+
+    Aggregates batch by batch with Arrow group_by, so memory does not grow with the number of rounds.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(os.path.join(out_dir, "rounds"), format="parquet", partitioning="hive")
+    condition = None
+    if role is not None:
+        condition = ds.field("role") == role
+    if since is not None:
+        since_filter = ds.field("played_at") >= pa.scalar(since, type=pa.timestamp("ms"))
+        condition = since_filter if condition is None else condition & since_filter
+
+    totals = None
+    for batch in dataset.to_batches(columns=["category", "is_correct", "points", "possible_points"], filter=condition):
+        table = pa.Table.from_batches([batch])
+        table = table.set_column(1, "is_correct", pc.cast(table["is_correct"], pa.int64()))
+        partial = table.group_by("category").aggregate(
+            [("is_correct", "sum"), ("is_correct", "count"), ("points", "sum"), ("possible_points", "sum")]
+        ).to_pandas()
+        # Fold each batch into the running totals, which hold one row per category
+        combined = partial if totals is None else pd.concat([totals, partial])
+        totals = combined.groupby("category", as_index=False).sum()
+    if totals is None:
+        return pd.DataFrame(columns=["category", "rounds", "correct", "accuracy", "points_share"])
+
+    totals = totals.rename(columns={"is_correct_sum": "correct", "is_correct_count": "rounds"})
+    totals["accuracy"] = totals["correct"] / totals["rounds"]
+    totals["points_share"] = totals["points_sum"] / totals["possible_points_sum"]
+    return totals[["category", "rounds", "correct", "accuracy", "points_share"]].sort_values("accuracy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["export", "accuracy"])
+    parser.add_argument("--out", default="exports", help="export directory")
+    parser.add_argument("--history", default=Config.HISTORY_PATH)
+    parser.add_argument("--store", default=Config.SCENARIO_STORE_PATH)
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--role", help="accuracy: only rounds played in this role")
+    parser.add_argument("--days", type=int, help="accuracy: only rounds from the last N days")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        os.makedirs(args.out, exist_ok=True)
+        state = load_state(args.out)
+        started = time.monotonic()
+        rounds = export_rounds(args.history, args.out, state, args.batch_rows)
+        save_state(args.out, state)
+        scenarios = export_scenarios(args.store, args.out, args.batch_rows)
+        print(f"Exported {rounds} new rounds and {scenarios} scenarios to {args.out} in {time.monotonic() - started:.1f}s")
+        return 0
+
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days) if args.days else None
+    print(category_accuracy(args.out, role=args.role, since=since).to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())